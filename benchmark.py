@@ -0,0 +1,274 @@
+"""
+Benchmarks of the hot path of social_api against sqlite database with fake provider. Results are printed in JSON
+for comparison between commits.
+
+Example usage:
+
+    $ python benchmark.py
+    $ python benchmark.py --only get_token call_overhead --iterations 1000 --output results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+
+PROVIDER = 'benchmark'
+TOKENS_COUNTS = (10, 100, 1000, 10000, 100000)
+
+
+def setup(directory):
+    try:
+        import settings_test
+        installed_apps = tuple(settings_test.INSTALLED_APPS)
+    except ImportError:
+        installed_apps = ('taggit', 'oauth_tokens', 'social.apps.django_app.default')
+    # database and cache are files to be shared by processes of update_tokens benchmark
+    settings.configure(
+        DEBUG=False,
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': os.path.join(directory, 'database.db')}},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                            'LOCATION': os.path.join(directory, 'cache')}},
+        INSTALLED_APPS=('django.contrib.auth', 'django.contrib.contenttypes') + installed_apps + ('social_api',),
+        SOCIAL_API_SOCIAL_AUTH_PROVIDERS_MAP={PROVIDER: PROVIDER},
+        SOCIAL_API_TOKENS_POOL_TIMEOUT=60 * 60,
+    )
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    from django.core.management import call_command
+    try:
+        call_command('migrate', verbosity=0, interactive=False)
+    except Exception:
+        call_command('syncdb', verbosity=0, interactive=False)
+
+
+def get_api():
+    import six
+    from social_api.api import ApiAbstractBase, Singleton
+    from social_api.retry import RetryPolicy, RepeatCall
+
+    class BenchmarkError(Exception):
+        def __init__(self, code):
+            super(BenchmarkError, self).__init__(code)
+            self.code = code
+
+    class BenchmarkApi(six.with_metaclass(Singleton, ApiAbstractBase)):
+        """
+        Provider without network: response is the token, first `fail` calls raise error, that is repeated
+        """
+        provider = PROVIDER
+        error_class = BenchmarkError
+        retry_policy = RetryPolicy(max_attempts=100, backoff=0, jitter=0)
+        response_cache_timeouts = {}
+        coalesce_methods = ()
+        fail = 0
+
+        def get_api(self, token):
+            return token
+
+        def get_api_response(self, *args, **kwargs):
+            if self.fail:
+                self.fail -= 1
+                raise BenchmarkError(1)
+            return self.api
+
+        def handle_error_code_1(self, e, *args, **kwargs):
+            return RepeatCall('code_1', e, args, kwargs, sleep=False)
+
+    return BenchmarkApi()
+
+
+def create_tokens(count):
+    from oauth_tokens.models import AccessToken
+    from social_api.utils import clear_tokens_cache
+    AccessToken.objects.filter(provider=PROVIDER).delete()
+    AccessToken.objects.bulk_create([AccessToken(provider=PROVIDER, access_token='token%d' % i)
+                                     for i in range(count)])
+    clear_tokens_cache()
+
+
+def measure(func, iterations):
+    """
+    Returns statistics of time of func calls in microseconds
+    """
+    timings = []
+    for i in range(iterations):
+        started_at = time.time()
+        func()
+        timings.append((time.time() - started_at) * 10 ** 6)
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'mean_us': round(sum(timings) / len(timings), 2),
+        'p50_us': round(timings[len(timings) // 2], 2),
+        'p99_us': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 2),
+    }
+
+
+def benchmark_call_overhead(iterations):
+    """
+    Time of call with successful response, tokens are in the pool
+    """
+    api = get_api()
+    create_tokens(100)
+    api.get_tokens()
+    return measure(lambda: api.call('method'), iterations)
+
+
+def benchmark_get_token(iterations):
+    """
+    Time of token selection by size of the pool, without and with excluded tokens of the call chain
+    """
+    from social_api.cache import tokens_pool
+    from social_api.utils import get_context_key
+
+    api = get_api()
+    results = {}
+    for count in TOKENS_COUNTS:
+        tokens = ['token%d' % i for i in range(count)]
+        tokens_pool.set(PROVIDER, get_context_key(PROVIDER), tokens)
+        with api.call_scope('method'):
+            results[count] = {'excluded_0': measure(api.get_token, iterations)}
+            api.used_access_tokens = tokens[:count // 2]
+            results[count]['excluded_half'] = measure(api.get_token, iterations)
+    tokens_pool.invalidate(PROVIDER)
+    return results
+
+
+def benchmark_retry(iterations):
+    """
+    Time of call with 5 repeated errors before the response, per repeat
+    """
+    api = get_api()
+    create_tokens(100)
+
+    def call():
+        api.fail = 5
+        api.call('method')
+
+    result = measure(call, iterations)
+    result['repeats'] = 5
+    result['mean_per_repeat_us'] = round(result['mean_us'] / 6, 2)
+    return result
+
+
+def benchmark_storage_queries(iterations):
+    """
+    Number of database queries of cold and warm getting of tokens
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    api = get_api()
+    create_tokens(100)
+    results = {}
+    with CaptureQueriesContext(connection) as queries:
+        api.get_tokens()
+    results['cold_queries'] = len(queries)
+    with CaptureQueriesContext(connection) as queries:
+        for i in range(iterations):
+            api.call('method')
+    results['warm_queries_per_call'] = float(len(queries)) / iterations
+    api.invalidate_tokens()
+    results['cold'] = measure(lambda: (api.invalidate_tokens(), api.get_tokens()), min(iterations, 100))
+    return results
+
+
+def update_tokens_worker(delay):
+    from django.db import connection
+    from oauth_tokens.models import AccessToken
+    from social_api.storages.oauthtokens import OAuthTokensStorage
+
+    connection.close()
+    fetches = []
+
+    def fetch(*args, **kwargs):
+        fetches.append(1)
+        time.sleep(delay)
+
+    manager = type(AccessToken.objects)
+    original, manager.fetch = manager.fetch, fetch
+    try:
+        started_at = time.time()
+        OAuthTokensStorage(PROVIDER).update_tokens()
+        return time.time() - started_at, len(fetches)
+    finally:
+        manager.fetch = original
+
+
+def benchmark_update_tokens(iterations, processes=8, delay=0.2):
+    """
+    Concurrent update_tokens of many processes: number of real fetches and time of waiting
+    """
+    from django.db import connection
+
+    create_tokens(100)
+    connection.close()
+    # workers use settings of this process, so they should be forked
+    context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    results = []
+    for i in range(max(1, min(iterations // 100, 5))):
+        pool = context.Pool(processes)
+        try:
+            started_at = time.time()
+            workers = pool.map(update_tokens_worker, [delay] * processes)
+            wall = time.time() - started_at
+        finally:
+            pool.close()
+            pool.join()
+        results.append({'fetches': sum(fetches for duration, fetches in workers), 'wall_s': round(wall, 3),
+                        'max_process_s': round(max(duration for duration, fetches in workers), 3)})
+    return {'processes': processes, 'fetch_delay_s': delay, 'runs': results}
+
+
+BENCHMARKS = (
+    ('call_overhead', benchmark_call_overhead),
+    ('get_token', benchmark_get_token),
+    ('retry', benchmark_retry),
+    ('storage_queries', benchmark_storage_queries),
+    ('update_tokens', benchmark_update_tokens),
+)
+
+
+def run(names, iterations):
+    import django
+    results = {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'benchmarks': {},
+    }
+    for name, benchmark in BENCHMARKS:
+        if not names or name in names:
+            results['benchmarks'][name] = benchmark(iterations)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run benchmarks of social_api and print results in JSON.")
+    parser.add_argument('--only', nargs='+', choices=[name for name, benchmark in BENCHMARKS])
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--output', help="file for results instead of stdout")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        setup(directory)
+        results = run(args.only, args.iterations)
+    finally:
+        shutil.rmtree(directory)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
@@ -1,2 +1,10 @@
 VERSION = (0, 1, 1)
 __version__ = '.'.join(map(str, VERSION))
+
+
+def warmup(providers=None, contexts=None):
+    """
+    Loads pools of tokens of providers before the first calls, could be used in AppConfig.ready
+    """
+    from .prefetch import warmup
+    return warmup(providers, contexts)
@@ -0,0 +1,45 @@
+import bisect
+import hashlib
+
+import six
+from django.conf import settings
+
+
+AFFINITY_REPLICAS = getattr(settings, 'SOCIAL_API_AFFINITY_REPLICAS', 40)
+
+
+def get_hash(value):
+    return int(hashlib.md5(six.text_type(value).encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto nodes, each node is placed on the ring `replicas` times. When node is added
+    or removed, only keys of it's arcs are remapped to the neighbour nodes
+    """
+
+    def __init__(self, nodes, replicas=AFFINITY_REPLICAS):
+        self.nodes = nodes
+        self._count = len(set(nodes))
+        ring = sorted((get_hash('%s-%d' % (node, i)), node) for node in set(nodes) for i in range(replicas))
+        self._hashes = [value for value, node in ring]
+        self._ring = [node for value, node in ring]
+
+    def iter_nodes(self, key):
+        """
+        Iterate over distinct nodes clockwise from the position of key, the first one is the node of key
+        """
+        if not self._ring:
+            return
+        start = bisect.bisect(self._hashes, get_hash(key))
+        seen = set()
+        for i in range(len(self._ring)):
+            node = self._ring[(start + i) % len(self._ring)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == self._count:
+                    return
+
+    def get_node(self, key):
+        return next(self.iter_nodes(key), None)
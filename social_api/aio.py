@@ -0,0 +1,240 @@
+"""
+Asyncio counterpart of ApiAbstractBase.call, available on Python 3.5+
+"""
+import asyncio
+import functools
+
+from .cache import tokens_pool
+from .exceptions import CallTimeoutError, NoActiveTokens
+from .metrics import timer
+from .retry import RepeatCall
+from .singleflight import copy_result
+from .utils import (call_deadline, check_deadline, get_storages, get_prioritized_storages, get_call_contexts,
+                    get_context_key, get_remaining_time, set_call_contexts)
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Run blocking function in the default executor of the running loop
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+class AsyncApiMixin(object):
+    """
+    Async methods of ApiAbstractBase. Subclasses could define native coroutines `aget_api_response`
+    and `ahandle_error_code_<code>`, otherwise sync versions are executed in the default executor.
+    Handlers return `repeat_call` or `sleep_repeat_call` to repeat the call without blocking the loop
+    """
+
+    async def acall(self, method, *args, **kwargs):
+        with call_deadline(self.get_call_timeout()):
+            return await self.acall_in_deadline(method, *args, **kwargs)
+
+    async def acall_in_deadline(self, method, *args, **kwargs):
+        timeout = self.get_response_cache_timeout(method)
+        coalesce = self.is_coalesced(method)
+        if not timeout and not coalesce:
+            return await self.acall_uncached(method, *args, **kwargs)
+
+        key = self.response_cache.get_key(method, args, kwargs, self.get_call_key())
+        if timeout:
+            hit, response = self.response_cache.get(key)
+            if hit:
+                return response
+
+        if coalesce:
+            # identical calls of tasks of the same loop wait for the first one
+            flights = self.__dict__.setdefault('_async_flights', {})
+            flight_key = (id(asyncio.get_event_loop()), key)
+            flight = flights.get(flight_key)
+            if flight is not None:
+                try:
+                    response = await asyncio.wait_for(asyncio.shield(flight), get_remaining_time())
+                    return copy_result(response)
+                except asyncio.TimeoutError:
+                    raise CallTimeoutError("Deadline of the call achieved before waiting for identical call")
+                except asyncio.CancelledError:
+                    if not flight.cancelled():
+                        # the waiting task is cancelled itself
+                        raise
+                # task of identical call is cancelled, one of waiting tasks makes the call for others
+                return await self.acall_in_deadline(method, *args, **kwargs)
+            future = flights[flight_key] = asyncio.get_event_loop().create_future()
+        try:
+            response = await self.acall_uncached(method, *args, **kwargs)
+            if timeout:
+                self.response_cache.set(key, response, timeout)
+            if coalesce:
+                future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            if coalesce:
+                future.cancel()
+            raise
+        except Exception as e:
+            if coalesce:
+                future.set_exception(e)
+                # mark exception as retrieved, it's raised here anyway
+                future.exception()
+            raise
+        finally:
+            if coalesce:
+                del flights[flight_key]
+
+    async def acall_uncached(self, method, *args, **kwargs):
+        with self.call_scope(method), timer(self.provider, 'call', method=method):
+            while True:
+                check_deadline(action='call of method %s' % method)
+                response = await self.acall_once(*args, **kwargs)
+                if not isinstance(response, RepeatCall):
+                    return response
+                seconds = self.start_repeat(response)
+                if seconds:
+                    await asyncio.sleep(seconds)
+                args, kwargs = response.args, response.kwargs
+
+    async def acall_once(self, *args, **kwargs):
+        await self.arun_registries(self.start_call_once)
+        try:
+            with timer(self.provider, 'token_selection', method=self.method):
+                token = await self.aget_token()
+        except NoActiveTokens as e:
+            self.set_no_active_tokens(e)
+            return await self.ahandle_error_no_active_tokens(e, *args, **kwargs)
+
+        started_at = await self.arun_registries(self.use_token, token)
+        try:
+            response = await self.aget_api_response(*args, **kwargs)
+            await self.arun_registries(self.record_response, token, started_at)
+        except self.error_class as e:
+            self.set_retry_kind('message', e)
+            response = await self.ahandle_error_message(e, *args, **kwargs)
+            if response is not None:
+                await self.arun_registries(self.record_call_result, token, token_failed=True)
+                return response
+            used_tokens_count = self.start_error_code(e)
+            try:
+                response = await self.ahandle_error_code(e, *args, **kwargs)
+            finally:
+                await self.arun_registries(self.record_failed_tokens, token, used_tokens_count)
+        except self.error_class_repeat as e:
+            await self.arun_registries(self.record_error_repeat, token, e)
+            response = await self.ahandle_error_repeat(e, *args, **kwargs)
+        except Exception as e:
+            return self.log_and_raise(e, *args, **kwargs)
+
+        return response
+
+    async def run_in_call_state(self, func, *args, **kwargs):
+        """
+        Run blocking method in executor with the state, contexts and deadline of the current call chain
+        """
+        state = self._state
+        contexts = get_call_contexts()
+        remaining = get_remaining_time()
+
+        def run():
+            previous, previous_contexts = self._call_state.get(), get_call_contexts()
+            self._call_state.set(state)
+            set_call_contexts(contexts)
+            try:
+                with call_deadline(remaining):
+                    return func(*args, **kwargs)
+            finally:
+                self._call_state.set(previous)
+                set_call_contexts(previous_contexts)
+
+        return await run_sync(run)
+
+    async def arun_registries(self, func, *args, **kwargs):
+        """
+        Run method using registries of tokens in executor if they are kept in Django cache, otherwise in the loop
+        """
+        if self.shared_registries:
+            return await self.run_in_call_state(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    async def acall_storage(self, storage, name):
+        """
+        Call async hook `a<name>` of the storage if it's defined, otherwise run sync `<name>` in executor
+        with the deadline of the current call
+        """
+        coroutine = getattr(storage, 'a%s' % name, None)
+        if coroutine is not None:
+            return await coroutine()
+        return await self.run_in_call_state(getattr(storage, name))
+
+    async def aget_api_response(self, *args, **kwargs):
+        return await self.run_in_call_state(self.get_api_response, *args, **kwargs)
+
+    async def ahandle_error_no_active_tokens(self, e, *args, **kwargs):
+        if self.release_used_tokens():
+            return self.sleep_repeat_call(*args, **kwargs)
+        await self.aupdate_tokens()
+        return self.repeat_call(*args, **kwargs)
+
+    async def ahandle_error_message(self, e, *args, **kwargs):
+        return await self.arun_registries(self.handle_error_message, e, *args, **kwargs)
+
+    async def ahandle_error_code(self, e, *args, **kwargs):
+        try:
+            handler = getattr(self, 'ahandle_error_code_%s' % self.get_error_code(e), None)
+        except AttributeError:
+            handler = None
+        if handler is not None:
+            return await handler(e, *args, **kwargs)
+        # sync handler or reraising of unknown error
+        return await self.run_in_call_state(self.handle_error_code, e, *args, **kwargs)
+
+    async def ahandle_error_repeat(self, e, *args, **kwargs):
+        return self.handle_error_repeat(e, *args, **kwargs)
+
+    async def aupdate_tokens(self):
+        await self.acall_storages('update_tokens')
+
+    async def arefresh_tokens(self):
+        await self.acall_storages('refresh_tokens')
+
+    async def acall_storages(self, name):
+        self.consistent_token = None
+        for storage in get_storages(self.provider):
+            await self.acall_storage(storage, name)
+        self.invalidate_tokens()
+        self.invalidate_clients()
+
+    async def aget_tokens(self):
+        key = get_context_key(self.provider)
+        tokens = tokens_pool.get(self.provider, key)
+        if tokens is None:
+            with timer(self.provider, 'storage_query'):
+                tokens = await self.aget_storages_tokens()
+            tokens_pool.set(self.provider, key, tokens)
+        return tokens
+
+    async def aget_storages_tokens(self):
+        tokens = []
+        for storage in get_prioritized_storages(self.provider):
+            if hasattr(storage, 'aget_tokens'):
+                storage_tokens = list(await storage.aget_tokens())
+            else:
+                storage_tokens = await run_sync(lambda: list(storage.get_tokens()))
+            tokens += storage_tokens
+        return tokens
+
+    async def aget_token(self):
+        if await self.arun_registries(self.is_consistent_token_allowed):
+            tokens = None
+        else:
+            tokens = self.tokens = await self.aget_tokens()
+            if not tokens:
+                await self.aupdate_tokens()
+                tokens = self.tokens = await self.aget_tokens()
+                self.check_updated_tokens(tokens)
+        while True:
+            token, wait = await self.arun_registries(self.reserve_token, tokens)
+            if token is not None:
+                return token
+            check_deadline(wait, 'waiting for rate limit of tokens')
+            await asyncio.sleep(wait)
@@ -3,8 +3,9 @@ import logging
 import socket
 import sys
 import time
-import random
 import six
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from six.moves.http_client import BadStatusLine, ResponseNotReady, IncompleteRead
 from abc import ABCMeta, abstractmethod, abstractproperty
 from ssl import SSLError
@@ -12,82 +13,547 @@ from ssl import SSLError
 from requests.exceptions import ConnectionError
 from django.conf import settings
 
-from .exceptions import NoActiveTokens
-from .utils import get_storages, override_api_context
+try:
+    from .aio import AsyncApiMixin
+except SyntaxError:
+    # python < 3.5 has no async/await syntax
+    AsyncApiMixin = object
+from .affinity import AFFINITY_REPLICAS, HashRing
+from .breakers import CIRCUIT_BREAKER, CircuitBreakers
+from .cache import LRUCache, is_shared, tokens_pool
+from .exceptions import NoActiveTokens, CallsLimitError, CallTimeoutError, CircuitOpenError
+from .health import TOKENS_HEALTH, TokensHealth
+from .metrics import increment, timer, timing
+from .pagination import OffsetPagination, CursorPagination
+from .responses import RESPONSE_CACHE_TIMEOUTS, ResponseCache
+from .retry import DEFAULT_RETRY_POLICY, RepeatCall
+from .sessions import get_session
+from .singleflight import SingleFlight
+from .usage import TOKENS_USAGE, TokensUsage
+from .utils import (ContextLocal, call_deadline, check_deadline, get_storages, iter_storages_tokens, get_call_context,
+                    get_call_contexts, get_context_key, get_remaining_time, get_token_scheduler, override_api_context,
+                    set_call_contexts)
+
+
+__all__ = ['NoActiveTokens', 'CircuitOpenError', 'CallTimeoutError', 'ApiAbstractBase', 'Singleton',
+           'override_api_context', 'OffsetPagination', 'CursorPagination']
+
+CALL_MANY_CONCURRENCY = getattr(settings, 'SOCIAL_API_CALL_MANY_CONCURRENCY', 10)
+API_CLIENTS_CACHE_SIZE = getattr(settings, 'SOCIAL_API_CLIENTS_CACHE_SIZE', 100)
+CALL_TIMEOUT = getattr(settings, 'SOCIAL_API_CALL_TIMEOUT', None)
+COALESCE_METHODS = getattr(settings, 'SOCIAL_API_COALESCE_METHODS', {})
+COALESCE_DISTRIBUTED = getattr(settings, 'SOCIAL_API_COALESCE_DISTRIBUTED', False)
+
+
+class UsedTokens(list):
+    """
+    List of tokens excluded from the call chain with O(1) check of membership
+    """
+
+    def __init__(self, tokens=()):
+        super(UsedTokens, self).__init__(tokens)
+        self._tokens = set(self)
+
+    def __contains__(self, token):
+        return token in self._tokens
+
+    def append(self, token):
+        super(UsedTokens, self).append(token)
+        self._tokens.add(token)
+
+    def extend(self, tokens):
+        tokens = list(tokens)
+        super(UsedTokens, self).extend(tokens)
+        self._tokens.update(tokens)
+
+    def __iadd__(self, tokens):
+        self.extend(tokens)
+        return self
+
+    def remove(self, token):
+        super(UsedTokens, self).remove(token)
+        self._tokens = set(self)
+
+    def pop(self, *args):
+        token = super(UsedTokens, self).pop(*args)
+        self._tokens = set(self)
+        return token
+
+
+class CallState(object):
+    """
+    State of the call chain: the top level call and all it's repeats
+    """
+
+    def __init__(self, method=None, pinned_token=None):
+        self.method = method
+        self.pinned_token = pinned_token
+        self.token = None
+        self.api = None
+        self.consistent_token = None
+        # key of the call, that is consistently mapped to the token
+        self.affinity = None
+        self.tokens = []
+        self.used_access_tokens = UsedTokens()
+        self.recursion_count = 0
+        self.depth = 0
+        # kind and exception of the error being handled, attempts of each kind of repeats
+        self.retry_kind = None
+        self.error = None
+        self.attempts = {}
+        self.started_at = time.time()
 
 
-__all__ = ['NoActiveTokens', 'ApiAbstractBase', 'Singleton', 'override_api_context']
+def call_state_property(name):
+    def getter(self):
+        return getattr(self._state, name)
 
+    def setter(self, value):
+        setattr(self._state, name, value)
 
-class ApiAbstractBase(object):
+    return property(getter, setter)
+
+
+class ApiAbstractBase(AsyncApiMixin):
     __metaclass__ = ABCMeta
 
-    consistent_token = None
     error_class_repeat = (SSLError, ConnectionError, socket.error, BadStatusLine, ResponseNotReady, IncompleteRead)
     sleep_repeat_error_messages = []
 
-    recursion_count = 0
+    # import path of token scheduler, by default SOCIAL_API_TOKEN_SCHEDULER setting is used
+    token_scheduler = None
+
+    # retry policies for kinds of repeats: 'repeat' for error_class_repeat exceptions, 'message' for
+    # sleep_repeat_error_messages, 'code_<code>' and 'code' for error codes, 'no_active_tokens'
+    retry_policy = DEFAULT_RETRY_POLICY
+    retry_policies = {}
+
+    # config of circuit breakers of provider and tokens, None disables them
+    circuit_breaker = CIRCUIT_BREAKER
+
+    # config of registry of tokens health, that quarantines failed tokens, None disables it
+    tokens_health = TOKENS_HEALTH
+
+    # timeouts of cached responses of methods, by default SOCIAL_API_RESPONSE_CACHE_TIMEOUTS[provider] is used
+    response_cache_timeouts = None
+
+    # methods, identical concurrent calls of which are coalesced into one request, by default
+    # SOCIAL_API_COALESCE_METHODS[provider] is used. Calls of methods with cached responses are coalesced as well
+    coalesce_methods = None
+
+    # limit of time of call in seconds including retries, by default SOCIAL_API_CALL_TIMEOUT is used.
+    # Could be overridden by call context: override_api_context(provider, timeout=5)
+    call_timeout = None
+
+    # config of counters of calls of tokens with quotas, by default SOCIAL_API_TOKENS_USAGE[provider] is used
+    tokens_usage = None
 
-    method = None
-    used_access_tokens = None
+    # pagination strategy of paged methods for `iter_call` and strategies for exact methods
+    pagination = None
+    paginations = {}
+
+    # size of connection pool of shared HTTP session, by default SOCIAL_API_HTTP_POOL_SIZE is used
+    http_pool_size = None
+
+    # number of API clients cached by token, by default SOCIAL_API_CLIENTS_CACHE_SIZE is used, 0 disables cache
+    clients_cache_size = None
+
+    method = call_state_property('method')
+    api = call_state_property('api')
+    token = call_state_property('token')
+    tokens = call_state_property('tokens')
+    consistent_token = call_state_property('consistent_token')
+    recursion_count = call_state_property('recursion_count')
+
+    @property
+    def used_access_tokens(self):
+        return self._state.used_access_tokens
+
+    @used_access_tokens.setter
+    def used_access_tokens(self, tokens):
+        self._state.used_access_tokens = tokens if isinstance(tokens, UsedTokens) else UsedTokens(tokens)
 
     def __init__(self):
-        self.tokens = []
-        self.used_access_tokens = []
-        self.consistent_token = None
+        # instance is singleton, so state of calls is kept local for each thread and asyncio task
+        self._call_state = ContextLocal('%s_call_state' % self.provider, CallState)
+        self.scheduler = get_token_scheduler(self.provider, self.token_scheduler)
+        self.breakers = CircuitBreakers(self.provider, self.circuit_breaker) if self.circuit_breaker is not None \
+            else None
+        self.health = TokensHealth(self.provider, **self.tokens_health) if self.tokens_health is not None else None
+        self.response_cache = ResponseCache(self.provider, self.response_cache_timeouts
+                                            if self.response_cache_timeouts is not None
+                                            else RESPONSE_CACHE_TIMEOUTS.get(self.provider, {}))
+        self.singleflight = SingleFlight()
+        self.hash_rings = LRUCache(100)
+        tokens_usage = self.tokens_usage if self.tokens_usage is not None else TOKENS_USAGE.get(self.provider)
+        self.usage = TokensUsage(self.provider, **tokens_usage) if tokens_usage else None
+        clients_cache_size = self.clients_cache_size if self.clients_cache_size is not None \
+            else API_CLIENTS_CACHE_SIZE
+        self.clients = LRUCache(clients_cache_size) if clients_cache_size else None
+        # registries of tokens kept in Django cache, acall runs their methods in executor to not block the loop
+        self.shared_registries = any(is_shared(getattr(registry, 'cache', None))
+                                     for registry in [self.scheduler, self.breakers, self.health, self.usage])
         self.logger = self.get_logger()
-        self.api = None
+
+    @property
+    def _state(self):
+        return self._call_state.get()
+
+    @contextmanager
+    def call_scope(self, method):
+        """
+        Enter the call chain: the top level call starts with the new state, repeats reuse state of the chain
+        """
+        state = self._state
+        if not state.depth:
+            state = CallState(pinned_token=state.pinned_token)
+            self._call_state.set(state)
+        state.method = method
+        state.depth += 1
+        try:
+            yield state
+        finally:
+            state.depth -= 1
 
     def set_context(self):
         # define context of call on each calling, becouse instanse is singleton
-        self.consistent_token = None
+        self.consistent_token = self._state.pinned_token
 
-        context = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', None)
-        if context and self.provider in context and 'token' in context[self.provider]:
-            self.consistent_token = context[self.provider]['token']
+        context = get_call_context(self.provider)
+        if 'token' in context:
+            self.consistent_token = context['token']
+        self._state.affinity = context.get('affinity')
 
     def call(self, method, *args, **kwargs):
-        self.method = method
-        self.set_context()
+        with call_deadline(self.get_call_timeout()):
+            return self.call_in_deadline(method, *args, **kwargs)
+
+    def call_in_deadline(self, method, *args, **kwargs):
+        timeout = self.get_response_cache_timeout(method)
+        coalesce = self.is_coalesced(method)
+        if not timeout and not coalesce:
+            return self.call_uncached(method, *args, **kwargs)
+
+        key = self.response_cache.get_key(method, args, kwargs, self.get_call_key())
+        if timeout:
+            hit, response = self.response_cache.get(key)
+            if hit:
+                return response
 
+        def call():
+            response = self.call_uncached(method, *args, **kwargs)
+            if timeout:
+                self.response_cache.set(key, response, timeout)
+            return response
+
+        if coalesce:
+            return self.singleflight.do(key, call, distributed=COALESCE_DISTRIBUTED)
+        return call()
+
+    def get_call_timeout(self):
+        return get_call_context(self.provider).get('timeout', self.call_timeout if self.call_timeout is not None
+                                                   else CALL_TIMEOUT)
+
+    def get_request_timeout(self, default=None):
+        """
+        Timeout of HTTP request made in `get_api_response`: remaining time of the call or default if it's less.
+        Clients are cached between calls, so timeout shouldn't be passed to them in `get_api`
+        """
+        remaining = get_remaining_time()
+        if remaining is None:
+            return default
+        remaining = max(remaining, 0.001)
+        return remaining if default is None else min(default, remaining)
+
+    def is_coalesced(self, method):
+        if self._state.depth:
+            # calls from error handlers of the call chain are never coalesced to not wait for themselves
+            return False
+        methods = self.coalesce_methods if self.coalesce_methods is not None \
+            else COALESCE_METHODS.get(self.provider, ())
+        return method in methods or bool(self.response_cache.get_timeout(method))
+
+    def get_call_key(self):
+        """
+        Returns hashable key of the call context, that could affect responses: tokens and storages options
+        """
+        return get_context_key(self.provider), get_call_context(self.provider).get('token')
+
+    def get_response_cache_timeout(self, method):
+        """
+        Returns timeout of cached responses of method or None if responses are not cached.
+        Cache could be bypassed using call context: override_api_context(provider, response_cache=False)
+        """
+        if get_call_context(self.provider).get('response_cache', True):
+            return self.response_cache.get_timeout(method)
+
+    def call_uncached(self, method, *args, **kwargs):
+        with self.call_scope(method), timer(self.provider, 'call', method=method):
+            while True:
+                check_deadline(action='call of method %s' % method)
+                response = self.call_once(*args, **kwargs)
+                if not isinstance(response, RepeatCall):
+                    return response
+                seconds = self.start_repeat(response)
+                if seconds:
+                    time.sleep(seconds)
+                args, kwargs = response.args, response.kwargs
+
+    def call_once(self, *args, **kwargs):
+        self.start_call_once()
         try:
-            token = self.get_token()
+            with timer(self.provider, 'token_selection', method=self.method):
+                token = self.get_token()
         except NoActiveTokens as e:
+            self.set_no_active_tokens(e)
             return self.handle_error_no_active_tokens(e, *args, **kwargs)
 
-        self.api = self.get_api(token)
-
+        started_at = self.use_token(token)
         try:
             response = self.get_api_response(*args, **kwargs)
+            self.record_response(token, started_at)
         except self.error_class as e:
+            self.set_retry_kind('message', e)
             response = self.handle_error_message(e, *args, **kwargs)
             if response is not None:
+                self.record_call_result(token, token_failed=True)
                 return response
-            response = self.handle_error_code(e, *args, **kwargs)
+            used_tokens_count = self.start_error_code(e)
+            try:
+                response = self.handle_error_code(e, *args, **kwargs)
+            finally:
+                self.record_failed_tokens(token, used_tokens_count)
         except self.error_class_repeat as e:
+            self.record_error_repeat(token, e)
             response = self.handle_error_repeat(e, *args, **kwargs)
         except Exception as e:
             return self.log_and_raise(e, *args, **kwargs)
 
         return response
 
+    # steps of call_once shared with acall_once, methods using registries of tokens are run by acall_once
+    # in executor, if registries are kept in Django cache
+
+    def start_call_once(self):
+        self.set_context()
+        if self.breakers:
+            self.breakers.get().check()
+
+    def set_no_active_tokens(self, e):
+        increment(self.provider, 'no_active_tokens', method=self.method)
+        self.set_retry_kind('no_active_tokens', e)
+
+    def use_token(self, token):
+        """
+        Set token and it's client for the request and count it's usage, returns time of the start of the request
+        """
+        self.token = token
+        self.api = self.get_client(token)
+        if self.usage:
+            self.usage.record(token, self.method)
+        return time.time()
+
+    def record_response(self, token, started_at):
+        latency = time.time() - started_at
+        timing(self.provider, 'request', latency, method=self.method)
+        self.record_call_result(token, latency=latency)
+
+    def start_error_code(self, e):
+        """
+        Set retry kind of error code, returns number of used tokens before the error code handler
+        """
+        self.set_retry_kind(self.get_code_retry_kind(e), e)
+        return len(self.used_access_tokens)
+
+    def record_error_repeat(self, token, e):
+        self.record_call_result(token, provider_failed=True, token_failed=True)
+        self.set_retry_kind('repeat', e)
+
+    def record_call_result(self, token, provider_failed=False, token_failed=False, latency=None):
+        if not token_failed and self.health:
+            self.health.record_success(token, latency)
+        if not self.breakers:
+            return
+        for breaker, failed in [(self.breakers.get(), provider_failed), (self.breakers.get(token), token_failed)]:
+            if failed:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+    def record_failed_tokens(self, token, start):
+        """
+        Register result of the call with token and errors of tokens, that were marked as used by error handler
+        """
+        failed_tokens = self.used_access_tokens[start:]
+        self.record_call_result(token, token_failed=token in failed_tokens)
+        if failed_tokens:
+            # pool could have revoked tokens, that will be dropped by the next query
+            self.invalidate_tokens()
+        if not self.health:
+            return
+        for failed_token in failed_tokens:
+            self.health.record_error(failed_token)
+            if self.health.is_quarantined(failed_token):
+                self.invalidate_clients(failed_token)
+
+    def is_token_allowed(self, token):
+        if self.health and self.health.is_quarantined(token):
+            return False
+        return not self.breakers or self.breakers.get(token).allow()
+
+    def set_retry_kind(self, kind, e):
+        self._state.retry_kind = kind
+        self._state.error = e
+
+    def get_code_retry_kind(self, e):
+        try:
+            return 'code_%s' % self.get_error_code(e)
+        except AttributeError:
+            # error without code is reraised by handle_error_code
+            return 'code'
+
+    def get_retry_policy(self, kind):
+        policies = self.retry_policies
+        if kind in policies:
+            return policies[kind]
+        if kind.startswith('code_') and 'code' in policies:
+            return policies['code']
+        return self.retry_policy
+
+    def get_repeat_delay(self, repeat):
+        """
+        Count the repeat and return seconds to wait before it or raise CallsLimitError if retry policy is exhausted
+        """
+        state = self._state
+        policy = self.get_retry_policy(repeat.kind)
+        attempt = state.attempts.get(repeat.kind, 0) + 1
+        state.attempts[repeat.kind] = attempt
+        state.recursion_count += 1
+
+        seconds = 0
+        if repeat.sleep:
+            seconds = repeat.seconds if repeat.seconds is not None else policy.get_delay(attempt)
+
+        if attempt >= policy.max_attempts:
+            raise CallsLimitError("Limit of %d attempts for errors '%s' achieved, method %s, last error: %s"
+                                  % (policy.max_attempts, repeat.kind, self.method, repeat.error))
+        if policy.deadline is not None and time.time() - state.started_at + seconds > policy.deadline:
+            raise CallsLimitError("Deadline of %s sec for errors '%s' achieved, method %s, last error: %s"
+                                  % (policy.deadline, repeat.kind, self.method, repeat.error))
+        return seconds
+
+    def start_repeat(self, repeat):
+        """
+        Count the repeat of the current method and return seconds to sleep before it, if there is time till deadline
+        """
+        seconds = self.get_repeat_delay(repeat)
+        increment(self.provider, 'retries', method=self.method, kind=repeat.kind)
+        check_deadline(seconds, 'repeat of method %s after error %s' % (self.method, repeat.error))
+        if seconds:
+            timing(self.provider, 'sleep', seconds, method=self.method, kind=repeat.kind)
+        return seconds
+
+    def call_many(self, method, kwargs_list, concurrency=None):
+        """
+        Make calls of the method with each of kwargs in a pool of threads, spreading calls across distinct tokens.
+        Returns iterator over responses in order of kwargs_list, yielding them as soon as they are ready
+        """
+        kwargs_list = list(kwargs_list)
+        self.set_context()
+        tokens = [None] if self.consistent_token else list(self.get_tokens()) or [None]
+        if concurrency is None:
+            concurrency = min(len(tokens), CALL_MANY_CONCURRENCY)
+        concurrency = max(1, min(concurrency, len(kwargs_list)))
+
+        # threads of the pool don't inherit overridden call contexts
+        contexts = get_call_contexts()
+        tasks = [(method, tokens[i % len(tokens)], kwargs, contexts) for i, kwargs in enumerate(kwargs_list)]
+        pool = ThreadPool(concurrency)
+        try:
+            for response in pool.imap(self._call_many_task, tasks):
+                yield response
+        finally:
+            pool.terminate()
+
+    def iter_call(self, method, pagination=None, prefetch=False, **kwargs):
+        """
+        Iterate over items of all pages of the method, arguments of pages are given by pagination strategy,
+        by default by `get_pagination`. Only the current page is kept in memory, with prefetch the next page
+        is requested in background thread while items of the current one are consumed
+        """
+        pagination = pagination or self.get_pagination(method)
+        if pagination is None:
+            raise ValueError("There is no pagination for method %s of provider %s" % (method, self.provider))
+
+        pool = ThreadPool(1) if prefetch else None
+        contexts = get_call_contexts()
+        try:
+            kwargs = pagination.get_first_kwargs(kwargs)
+            response = self.call(method, **kwargs)
+            while True:
+                items = pagination.get_items(response)
+                kwargs = pagination.get_next_kwargs(kwargs, response, items)
+                next_response = None
+                if kwargs is not None and pool:
+                    next_response = pool.apply_async(self._iter_call_task, (method, kwargs, contexts))
+                del response
+                for item in items:
+                    yield item
+                del items
+                if kwargs is None:
+                    return
+                response = next_response.get() if next_response else self.call(method, **kwargs)
+        finally:
+            if pool:
+                pool.terminate()
+
+    def get_pagination(self, method):
+        return self.paginations.get(method, self.pagination)
+
+    def _iter_call_task(self, method, kwargs, contexts):
+        set_call_contexts(contexts)
+        try:
+            return self.call(method, **kwargs)
+        finally:
+            set_call_contexts(None)
+
+    def _call_many_task(self, task):
+        method, token, kwargs, contexts = task
+        self._state.pinned_token = token
+        set_call_contexts(contexts)
+        try:
+            return self.call(method, **kwargs)
+        finally:
+            self._state.pinned_token = None
+            set_call_contexts(None)
+
     def handle_error_no_active_tokens(self, e, *args, **kwargs):
+        if self.release_used_tokens():
+            return self.sleep_repeat_call(*args, **kwargs)
+        self.update_tokens()
+        return self.repeat_call(*args, **kwargs)
+
+    def release_used_tokens(self):
+        """
+        Empty used_access_tokens to wait and repeat with them, returns False if they are empty and tokens
+        should be updated
+        """
         if self.used_access_tokens:
-            # wait 1 sec and repeat with empty used_access_tokens
-            self.logger.warning("Waiting 1 sec, because all active tokens are used, method: %s, recursion count: %d" %
+            self.logger.warning("Waiting, because all active tokens are used, method: %s, recursion count: %d" %
                                 (self.method, self.recursion_count))
             self.used_access_tokens = []
-            return self.sleep_repeat_call(*args, **kwargs)
-        else:
-            self.logger.warning("Suddenly updating tokens, because no active access tokens and used_access_tokens "
-                                "empty, method: %s, recursion count: %d" % (self.method, self.recursion_count))
-            self.update_tokens()
-            return self.repeat_call(*args, **kwargs)
+            return True
+        self.logger.warning("Suddenly updating tokens, because no active access tokens and used_access_tokens "
+                            "empty, method: %s, recursion count: %d" % (self.method, self.recursion_count))
+        return False
 
     def handle_error_message(self, e, *args, **kwargs):
         # check if error message contains any of defined messages
         for message in self.sleep_repeat_error_messages:
             if message in str(e):
+                if self.scheduler.drain(self.token):
+                    # scheduler knows when token will have budget again, so it's not needed to sleep here
+                    return self.repeat_call(*args, **kwargs)
                 return self.sleep_repeat_call(*args, **kwargs)
         return
 
@@ -113,52 +579,186 @@ class ApiAbstractBase(object):
         return self.sleep_repeat_call(*args, **kwargs)
 
     def sleep_repeat_call(self, *args, **kwargs):
-        time.sleep(kwargs.pop('seconds', 1))
-        return self.repeat_call(*args, **kwargs)
+        """
+        Ask to repeat the call after backoff of retry policy or after given `seconds`. Outside of the call chain,
+        for example in override of `call`, the call is repeated right here after sleeping
+        """
+        seconds = kwargs.pop('seconds', None)
+        if not self._state.depth:
+            time.sleep(seconds if seconds is not None else 1)
+            return self.call(self.method, *args, **kwargs)
+        return RepeatCall(self._state.retry_kind or 'repeat', self._state.error, args, kwargs, seconds=seconds)
 
     def repeat_call(self, *args, **kwargs):
-        self.recursion_count += 1
-        return self.call(self.method, *args, **kwargs)
+        """
+        Ask to repeat the call immediately. Outside of the call chain the call is repeated right here
+        """
+        if not self._state.depth:
+            return self.call(self.method, *args, **kwargs)
+        return RepeatCall(self._state.retry_kind or 'repeat', self._state.error, args, kwargs, sleep=False)
 
     def update_tokens(self):
-        self.consistent_token = None
-        for storage in get_storages(self.provider):
-            storage.update_tokens()
+        self.call_storages('update_tokens')
 
     def refresh_tokens(self):
+        self.call_storages('refresh_tokens')
+
+    def call_storages(self, name):
+        """
+        Call method of all storages of provider and drop tokens and clients cached before
+        """
         self.consistent_token = None
         for storage in get_storages(self.provider):
-            storage.refresh_tokens()
+            getattr(storage, name)()
+        self.invalidate_tokens()
+        self.invalidate_clients()
+
+    def mark_token_used(self, token):
+        """
+        Exclude token from the current call chain and drop cached tokens, because the token failed
+        """
+        self.used_access_tokens += [token]
+        self.invalidate_tokens()
+
+    def invalidate_tokens(self):
+        tokens_pool.invalidate(self.provider)
 
     def get_tokens(self):
-        tokens = []
-        for storage in get_storages(self.provider):
-            storage_tokens = storage.get_tokens()
-            if storage.only_this:
-                return storage_tokens
-            tokens += storage_tokens
+        key = get_context_key(self.provider)
+        tokens = tokens_pool.get(self.provider, key)
+        if tokens is None:
+            with timer(self.provider, 'storage_query'):
+                tokens = self.get_storages_tokens()
+            tokens_pool.set(self.provider, key, tokens)
         return tokens
 
-    def get_token(self):
-        if self.consistent_token and self.consistent_token not in self.used_access_tokens:
-            return self.consistent_token
-
-        self.tokens = self.get_tokens()
+    def get_storages_tokens(self):
+        return list(self.iter_tokens())
 
-        if not self.tokens:
-            self.update_tokens()
-            self.tokens = self.get_tokens()
-            if not self.tokens:
-                raise NoActiveTokens("There is no active tokens for provider %s after updating" % self.provider)
+    def iter_tokens(self):
+        """
+        Lazy iterator over tokens of storages in order of priority
+        """
+        return iter_storages_tokens(self.provider)
 
-        tokens = self.tokens
-        if self.used_access_tokens:
-            tokens = list(set(tokens).difference(set(self.used_access_tokens)))
+    def get_token(self):
+        if self.is_consistent_token_allowed():
+            tokens = None
+        else:
+            tokens = self.tokens = self.get_tokens()
             if not tokens:
-                raise NoActiveTokens("There is no active tokens for provider %s, used_tokens: %s"
-                                     % (self.provider, self.used_access_tokens))
-
-        return random.choice(tokens)
+                self.update_tokens()
+                tokens = self.tokens = self.get_tokens()
+                self.check_updated_tokens(tokens)
+        return self.wait_for_token(self.reserve_token, tokens)
+
+    def is_consistent_token_allowed(self):
+        return bool(self.consistent_token) and self.consistent_token not in self.used_access_tokens \
+            and self.is_token_allowed(self.consistent_token)
+
+    def check_updated_tokens(self, tokens):
+        if not tokens:
+            raise NoActiveTokens("There is no active tokens for provider %s after updating" % self.provider)
+
+    def wait_for_token(self, reserve, tokens):
+        """
+        Returns token reserved by reserve(tokens), waiting for budget of scheduler
+        """
+        while True:
+            token, wait = reserve(tokens)
+            if token is not None:
+                return token
+            check_deadline(wait, 'waiting for rate limit of tokens')
+            time.sleep(wait)
+
+    def reserve_token(self, tokens):
+        """
+        Chooses token for the call without waiting: consistent token if tokens are None, token of affinity key,
+        token with remaining quota or any allowed token. Returns tuple (token, 0) or (None, seconds) to wait for
+        budget of scheduler
+        """
+        if tokens is None:
+            return self.scheduler.reserve([self.consistent_token])
+        token = self.get_affinity_token(tokens)
+        if token is not None:
+            return self.scheduler.reserve([token])
+        token = self.get_usage_token(tokens)
+        if token is not None:
+            return token, 0
+        return self.reserve_allowed_token(tokens)
+
+    def get_affinity_token(self, tokens):
+        """
+        Returns the first allowed token on the hash ring of tokens for the affinity key of the call context,
+        so calls with the same key use the same token while it's in the pool
+        """
+        affinity = self._state.affinity
+        if affinity is None:
+            return None
+        for token in self.get_hash_ring(tokens).iter_nodes(affinity):
+            if token in self.used_access_tokens:
+                continue
+            if self.is_token_allowed(token):
+                return token
+            self.used_access_tokens.append(token)
+        self.raise_no_active_tokens()
+
+    def get_usage_token(self, tokens):
+        """
+        Returns allowed token with budget of scheduler preferring ones with more remaining quota or None if quotas
+        are not limited or exhausted or all tokens with quota wait for budget
+        """
+        if not self.usage:
+            return None
+        exclude = self.used_access_tokens
+        while True:
+            token = self.usage.choose(tokens, self.method, exclude)
+            if token is None:
+                return None
+            if not self.is_token_allowed(token):
+                self.used_access_tokens.append(token)
+                if exclude is self.used_access_tokens:
+                    continue
+            elif self.scheduler.reserve([token])[0] is not None:
+                return token
+            elif exclude is self.used_access_tokens:
+                # tokens waiting for budget are skipped only while choosing token for this call
+                exclude = UsedTokens(exclude)
+            exclude.append(token)
+
+    def get_tokens_usage(self):
+        """
+        Returns usage of quotas of tokens in the current window: {token: {'used', 'remaining', 'methods'}}
+        """
+        return self.usage.get_stats(self.get_tokens()) if self.usage else {}
+
+    def get_hash_ring(self, tokens):
+        key = get_context_key(self.provider)
+        ring = self.hash_rings.get(key)
+        if ring is None or (ring.nodes is not tokens and ring.nodes != tokens):
+            ring = HashRing(tokens, AFFINITY_REPLICAS)
+            self.hash_rings.set(key, ring)
+        elif ring.nodes is not tokens:
+            # pool is refreshed with the same tokens, keep it to compare by identity next time
+            ring.nodes = tokens
+        return ring
+
+    def choose_token(self, tokens):
+        return self.wait_for_token(self.reserve_allowed_token, tokens)
+
+    def reserve_allowed_token(self, tokens):
+        while True:
+            token, wait = self.scheduler.reserve(tokens, self.used_access_tokens)
+            if token is None and wait is None:
+                self.raise_no_active_tokens()
+            if token is None or self.is_token_allowed(token):
+                return token, wait
+            # token is quarantined or it's circuit is open, exclude it from the current call chain
+            self.used_access_tokens.append(token)
+
+    def raise_no_active_tokens(self):
+        raise NoActiveTokens("There is no active tokens for provider %s, used_tokens: %s"
+                             % (self.provider, self.used_access_tokens))
 
     def get_logger(self):
         return logging.getLogger('%s_api' % self.provider)
@@ -175,6 +775,33 @@ class ApiAbstractBase(object):
     def get_api(self, token):
         pass
 
+    def get_client(self, token):
+        """
+        Returns API client of token from cache, client is built by `get_api` only once
+        """
+        if self.clients is None:
+            return self.get_api(token)
+        client = self.clients.get(token)
+        if client is None:
+            client = self.get_api(token)
+            self.clients.set(token, client)
+        return client
+
+    def invalidate_clients(self, token=None):
+        if self.clients is None:
+            return
+        if token is None:
+            self.clients.clear()
+        else:
+            self.clients.delete(token)
+
+    def get_session(self):
+        """
+        Keep-alive requests session of provider for clients built in `get_api`, so calls with different tokens
+        reuse connections instead of new handshakes
+        """
+        return get_session(self.provider, self.http_pool_size)
+
     @abstractmethod
     def get_api_response(self):
         pass
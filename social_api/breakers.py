@@ -0,0 +1,98 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+
+from .cache import get_cache, incr
+from .exceptions import CircuitOpenError
+
+
+CIRCUIT_BREAKER = getattr(settings, 'SOCIAL_API_CIRCUIT_BREAKER', None)
+
+
+class CircuitBreaker(object):
+    """
+    Opens circuit when rate of failures during the window exceeds threshold, fails fast while it's open
+    and lets limited number of probe calls after recovery timeout. Successful probe closes circuit,
+    failed one opens it again. State is kept in cache, so it could be shared between processes
+    """
+
+    def __init__(self, key, cache, failure_threshold=0.5, min_calls=20, window=60, recovery_timeout=30, probes=1):
+        self.key = 'social_api_breaker_%s' % key
+        self.cache = cache
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.recovery_timeout = recovery_timeout
+        self.probes = probes
+
+    def allow(self):
+        """
+        Returns True if call is allowed: circuit is closed or call is one of probes of half-open circuit
+        """
+        opened_until = self.cache.get('%s_open' % self.key)
+        if not opened_until:
+            return True
+        if time.time() < opened_until:
+            return False
+        return incr(self.cache, '%s_probes' % self.key, self.recovery_timeout) <= self.probes
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError("Circuit %s is open" % self.key)
+
+    def record_success(self):
+        opened_until = self.cache.get('%s_open' % self.key)
+        if opened_until is None:
+            incr(self.cache, self._get_window_key('calls'), self.window * 2)
+        elif time.time() >= opened_until:
+            # successful probe
+            self.close()
+
+    def record_failure(self):
+        opened_until = self.cache.get('%s_open' % self.key)
+        if opened_until is None:
+            calls = incr(self.cache, self._get_window_key('calls'), self.window * 2)
+            failures = incr(self.cache, self._get_window_key('failures'), self.window * 2)
+            if calls >= self.min_calls and float(failures) / calls >= self.failure_threshold:
+                self.open()
+        elif time.time() >= opened_until:
+            # failed probe
+            self.open()
+
+    def open(self):
+        self.cache.set('%s_open' % self.key, time.time() + self.recovery_timeout, self.recovery_timeout + self.window)
+        self.cache.delete('%s_probes' % self.key)
+
+    def close(self):
+        self.cache.delete('%s_open' % self.key)
+        self.cache.delete('%s_probes' % self.key)
+        self.cache.delete(self._get_window_key('calls'))
+        self.cache.delete(self._get_window_key('failures'))
+
+    def _get_window_key(self, name):
+        return '%s_%s_%d' % (self.key, name, int(time.time() / self.window))
+
+
+class CircuitBreakers(object):
+    """
+    Circuit breakers of provider and of it's access tokens, configured by SOCIAL_API_CIRCUIT_BREAKER
+    """
+
+    def __init__(self, provider, config=None):
+        config = dict(config or {})
+        self.provider = provider
+        self.cache = get_cache(config.pop('cache', None))
+        self.config = config
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, token=None):
+        key = self.provider
+        if token is not None:
+            key = '%s_%s' % (self.provider, hashlib.md5(token.encode('utf-8')).hexdigest())
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(key, self.cache, **self.config)
+            return self._breakers[key]
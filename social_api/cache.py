@@ -0,0 +1,181 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+TOKENS_POOL_TIMEOUT = getattr(settings, 'SOCIAL_API_TOKENS_POOL_TIMEOUT', 60)
+
+
+class TokensPool(object):
+    """
+    In-process cache of token lists per provider and per call context with expiration
+    """
+
+    def __init__(self, timeout=TOKENS_POOL_TIMEOUT):
+        self.timeout = timeout
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider, key):
+        with self._lock:
+            try:
+                expires_at, tokens = self._tokens[(provider, key)]
+            except KeyError:
+                return None
+            if expires_at < time.time():
+                del self._tokens[(provider, key)]
+                return None
+            return tokens
+
+    def set(self, provider, key, tokens):
+        if not self.timeout:
+            return
+        with self._lock:
+            self._tokens[(provider, key)] = (time.time() + self.timeout, list(tokens))
+
+    def invalidate(self, provider=None):
+        with self._lock:
+            if provider is None:
+                self._tokens.clear()
+            else:
+                for key in [key for key in self._tokens if key[0] == provider]:
+                    del self._tokens[key]
+
+
+tokens_pool = TokensPool()
+
+
+class LocalCache(object):
+    """
+    Thread-safe in-process cache with subset of Django cache API: get, get_many, set, add, incr, delete
+    """
+    max_entries = 10000
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        try:
+            value, expires_at = self._data[key]
+        except KeyError:
+            return None
+        if expires_at is not None and expires_at < time.time():
+            del self._data[key]
+            return None
+        return value
+
+    def _set(self, key, value, timeout):
+        if len(self._data) >= self.max_entries:
+            self._cull()
+        self._data[key] = (value, time.time() + timeout if timeout else None)
+
+    def _cull(self):
+        now = time.time()
+        for key in [key for key, (value, expires_at) in self._data.items() if expires_at and expires_at < now]:
+            del self._data[key]
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key)
+        return default if value is None else value
+
+    def get_many(self, keys):
+        with self._lock:
+            values = dict((key, self._get(key)) for key in keys)
+        return dict((key, value) for key, value in values.items() if value is not None)
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            value += delta
+            self._data[key] = (value, self._data[key][1])
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+def get_cache(alias=None):
+    """
+    Returns Django cache by alias or new in-process cache if alias is empty
+    """
+    return caches[alias] if alias else LocalCache()
+
+
+def is_shared(cache):
+    """
+    Returns True if cache is Django cache, operations of which could make network requests
+    """
+    return cache is not None and not isinstance(cache, LocalCache)
+
+
+def incr(cache, key, timeout, delta=1):
+    """
+    Atomic increment of counter, that is created with timeout if it doesn't exist
+    """
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # key expired between add and incr
+        cache.set(key, delta, timeout)
+        return delta
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process cache limited by number of entries with optional expiration of each entry
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at < time.time():
+                return default
+            # move to the end as the most recently used
+            self._data[key] = (value, expires_at)
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + timeout if timeout else None)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -4,3 +4,11 @@ class NoActiveTokens(Exception):
 
 class CallsLimitError(Exception):
     pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CallTimeoutError(CallsLimitError):
+    pass
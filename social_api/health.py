@@ -0,0 +1,59 @@
+import hashlib
+import time
+
+from django.conf import settings
+
+from .cache import get_cache, incr
+
+
+TOKENS_HEALTH = getattr(settings, 'SOCIAL_API_TOKENS_HEALTH', None)
+
+
+class TokensHealth(object):
+    """
+    Registry of errors and latency of access tokens. Token is quarantined after errors_threshold consecutive
+    errors for penalty seconds, growing twice with each next error up to max_penalty. Errors and quarantines
+    are kept in process or in the Django cache with alias `cache` shared between processes, latency is kept in process
+    """
+
+    def __init__(self, provider, cache=None, penalty=60, max_penalty=60 * 60, errors_threshold=1):
+        self.provider = provider
+        self.cache = get_cache(cache)
+        self.penalty = penalty
+        self.max_penalty = max_penalty
+        self.errors_threshold = errors_threshold
+        self._latency = {}
+
+    def record_success(self, token, latency=None):
+        key = self.get_key(token)
+        if self.cache.get('%s_errors' % key):
+            self.cache.delete('%s_errors' % key)
+        if latency is not None:
+            # exponentially weighted moving average
+            average = self._latency.get(token)
+            self._latency[token] = latency if average is None else average * 0.9 + latency * 0.1
+
+    def record_error(self, token, penalty=None):
+        key = self.get_key(token)
+        errors = incr(self.cache, '%s_errors' % key, self.max_penalty)
+        if errors >= self.errors_threshold:
+            if penalty is None:
+                penalty = min(self.max_penalty, self.penalty * 2 ** (errors - self.errors_threshold))
+            self.quarantine(token, penalty)
+
+    def quarantine(self, token, seconds):
+        self.cache.set('%s_quarantined' % self.get_key(token), time.time() + seconds, seconds)
+
+    def is_quarantined(self, token):
+        return self.cache.get('%s_quarantined' % self.get_key(token)) is not None
+
+    def get_stats(self, token):
+        key = self.get_key(token)
+        return {
+            'errors': self.cache.get('%s_errors' % key, 0),
+            'latency': self._latency.get(token),
+            'quarantined_until': self.cache.get('%s_quarantined' % key),
+        }
+
+    def get_key(self, token):
+        return 'social_api_health_%s_%s' % (self.provider, hashlib.md5(token.encode('utf-8')).hexdigest())
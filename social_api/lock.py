@@ -1,10 +1,30 @@
 # distributedlock settings
+import time
+
 import distributedlock
 from django.core.cache import get_cache
 
 
+cache = get_cache('default')
+
 distributedlock.DEFAULT_TIMEOUT = 60 * 5
-distributedlock.DEFAULT_MEMCACHED_CLIENT = get_cache('default')
+distributedlock.DEFAULT_MEMCACHED_CLIENT = cache
 
 # import after distributedlock settings
 from distributedlock import distributedlock, LockNotAcquiredError
+
+
+def wait_for(predicate, timeout, interval=0.05, max_interval=1):
+    """
+    Wait until predicate returns not None value with growing intervals of checks, returns None after timeout
+    """
+    deadline = time.time() + timeout
+    while True:
+        value = predicate()
+        if value is not None:
+            return value
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
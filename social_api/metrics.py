@@ -0,0 +1,160 @@
+import bisect
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.dispatch import Signal
+
+
+TIMING = 'timing'
+COUNTER = 'counter'
+
+METRICS_BUCKETS = getattr(settings, 'SOCIAL_API_METRICS_BUCKETS',
+                          (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+# sent by provider for every measurement with arguments name, kind (timing in seconds or counter), value and tags
+metric = Signal()
+
+
+def timing(provider, name, seconds, **tags):
+    tags['provider'] = provider
+    metric.send(sender=provider, name=name, kind=TIMING, value=seconds, tags=tags)
+
+
+def increment(provider, name, value=1, **tags):
+    tags['provider'] = provider
+    metric.send(sender=provider, name=name, kind=COUNTER, value=value, tags=tags)
+
+
+@contextmanager
+def timer(provider, name, **tags):
+    started_at = time.time()
+    try:
+        yield
+    finally:
+        timing(provider, name, time.time() - started_at, **tags)
+
+
+def format_tags(tags, extra=()):
+    tags = sorted(tags.items()) + list(extra)
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in tags) if tags else ''
+
+
+class MetricsCollector(object):
+    """
+    In-memory receiver of metrics: sums of counters and histograms of timings by name and tags.
+    Could be exported in Prometheus text format
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counters = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def receive(self, sender, name, kind, value, tags, **kwargs):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            if kind == COUNTER:
+                self._counters[key] = self._counters.get(key, 0) + value
+                return
+            histogram = self._timings.get(key)
+            if histogram is None:
+                histogram = self._timings[key] = {'buckets': [0] * (len(self.buckets) + 1), 'count': 0, 'sum': 0}
+            histogram['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    def connect(self):
+        metric.connect(self.receive, weak=False, dispatch_uid='social_api_metrics_collector_%d' % id(self))
+
+    def disconnect(self):
+        metric.disconnect(dispatch_uid='social_api_metrics_collector_%d' % id(self))
+
+    def get_counter(self, name, **tags):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(tags.items()))), 0)
+
+    def get_timing(self, name, **tags):
+        """
+        Returns dict with count, sum and counts of buckets of timing histogram, the last bucket is +Inf
+        """
+        with self._lock:
+            histogram = self._timings.get((name, tuple(sorted(tags.items()))))
+            if histogram is None:
+                return {'buckets': [0] * (len(self.buckets) + 1), 'count': 0, 'sum': 0}
+            return dict(histogram, buckets=list(histogram['buckets']))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+    def to_prometheus(self, prefix='social_api'):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted((key, dict(histogram, buckets=list(histogram['buckets'])))
+                             for key, histogram in self._timings.items())
+        lines = []
+        typed = set()
+        for (name, tags), value in counters:
+            metric_name = '%s_%s_total' % (prefix, name)
+            if metric_name not in typed:
+                typed.add(metric_name)
+                lines.append('# TYPE %s counter' % metric_name)
+            lines.append('%s%s %s' % (metric_name, format_tags(dict(tags)), value))
+        for (name, tags), histogram in timings:
+            metric_name = '%s_%s_seconds' % (prefix, name)
+            if metric_name not in typed:
+                typed.add(metric_name)
+                lines.append('# TYPE %s histogram' % metric_name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram['buckets']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (metric_name, format_tags(dict(tags), [('le', bound)]), cumulative))
+            lines.append('%s_sum%s %s' % (metric_name, format_tags(dict(tags)), histogram['sum']))
+            lines.append('%s_count%s %d' % (metric_name, format_tags(dict(tags)), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdExporter(object):
+    """
+    Receiver of metrics, that sends each of them to StatsD server by UDP
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='social_api'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, name, kind, value, tags):
+        path = '.'.join([self.prefix, str(tags.get('provider')), name] +
+                        [str(tag).replace('.', '_') for key, tag in sorted(tags.items()) if key != 'provider'])
+        if kind == COUNTER:
+            return '%s:%s|c' % (path, value)
+        return '%s:%.3f|ms' % (path, value * 1000)
+
+    def receive(self, sender, name, kind, value, tags, **kwargs):
+        try:
+            self._socket.sendto(self.format(name, kind, value, tags).encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+    def connect(self):
+        metric.connect(self.receive, weak=False, dispatch_uid='social_api_metrics_statsd_%d' % id(self))
+
+    def disconnect(self):
+        metric.disconnect(dispatch_uid='social_api_metrics_statsd_%d' % id(self))
+
+
+collector = MetricsCollector()
+if getattr(settings, 'SOCIAL_API_METRICS_COLLECTOR', False):
+    collector.connect()
+
+STATSD = getattr(settings, 'SOCIAL_API_METRICS_STATSD', None)
+statsd_exporter = StatsdExporter(**STATSD) if STATSD is not None else None
+if statsd_exporter:
+    statsd_exporter.connect()
@@ -0,0 +1,70 @@
+from abc import ABCMeta, abstractmethod
+
+
+class PaginationAbstractBase(object):
+    """
+    Strategy of requesting pages of paged method: extracts items from response and arguments of the next page
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, items_key='items'):
+        self.items_key = items_key
+
+    def get_items(self, response):
+        return response[self.items_key] if self.items_key else response
+
+    def get_first_kwargs(self, kwargs):
+        return kwargs
+
+    @abstractmethod
+    def get_next_kwargs(self, kwargs, response, items):
+        """
+        Returns arguments of the call of the next page or None if it's the last page
+        """
+        pass
+
+
+class OffsetPagination(PaginationAbstractBase):
+    """
+    Pages by offset and count arguments. The last page reaches total from response or is empty, without total
+    the last page is shorter than count
+    """
+
+    def __init__(self, count=100, offset_param='offset', count_param='count', total_key='count', **kwargs):
+        super(OffsetPagination, self).__init__(**kwargs)
+        self.count = count
+        self.offset_param = offset_param
+        self.count_param = count_param
+        self.total_key = total_key
+
+    def get_first_kwargs(self, kwargs):
+        return dict({self.count_param: self.count}, **kwargs)
+
+    def get_next_kwargs(self, kwargs, response, items):
+        count = kwargs.get(self.count_param, self.count)
+        offset = kwargs.get(self.offset_param, 0) + len(items)
+        total = response.get(self.total_key) if self.total_key and isinstance(response, dict) else None
+        if total is not None:
+            # provider could return less items than count, so only total marks the end
+            if not items or offset >= total:
+                return None
+        elif len(items) < count:
+            return None
+        return dict(kwargs, **{self.offset_param: offset, self.count_param: count})
+
+
+class CursorPagination(PaginationAbstractBase):
+    """
+    Pages by cursor argument, taken from response of the previous page. The last page has empty cursor
+    """
+
+    def __init__(self, cursor_param='cursor', next_cursor_key='next_cursor', **kwargs):
+        super(CursorPagination, self).__init__(**kwargs)
+        self.cursor_param = cursor_param
+        self.next_cursor_key = next_cursor_key
+
+    def get_next_kwargs(self, kwargs, response, items):
+        cursor = response.get(self.next_cursor_key)
+        if not items or not cursor or cursor == kwargs.get(self.cursor_param):
+            return None
+        return dict(kwargs, **{self.cursor_param: cursor})
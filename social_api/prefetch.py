@@ -0,0 +1,40 @@
+from .cache import tokens_pool
+from .singleflight import SingleFlight
+from .utils import PROVIDERS, STORAGES, get_context_key, get_storage_class, get_storages_tokens, override_api_context
+
+
+singleflight = SingleFlight()
+
+
+def prefetch_tokens(providers):
+    """
+    Returns dict {storage class: {provider: tokens}} with tokens of providers loaded by one query per storage
+    """
+    prefetched = {}
+    for import_path in STORAGES:
+        TokensStorage = get_storage_class(import_path)
+        prefetched[TokensStorage] = TokensStorage.prefetch_tokens(providers)
+    return prefetched
+
+
+def warmup(providers=None, contexts=None):
+    """
+    Loads pools of tokens of providers in the default context and in each of contexts, for example
+    [{'oauth_tokens_tag': 'tag'}]. Tokens of the default context are loaded in one query per storage and
+    shared between processes, that warm up at the same time. Returns dict with numbers of tokens of providers
+    """
+    providers = sorted(providers or PROVIDERS)
+    prefetched = singleflight.do('warmup_%s' % '_'.join(providers), lambda: prefetch_tokens(providers),
+                                 distributed=True)
+
+    counts = {}
+    for provider in providers:
+        tokens = get_storages_tokens(provider, prefetched)
+        tokens_pool.set(provider, get_context_key(provider), tokens)
+        counts[provider] = len(tokens)
+
+    for context in contexts or []:
+        for provider in providers:
+            with override_api_context(provider, **context):
+                tokens_pool.set(provider, get_context_key(provider), get_storages_tokens(provider))
+    return counts
@@ -0,0 +1,46 @@
+import hashlib
+
+from django.conf import settings
+from six.moves import cPickle as pickle
+
+from .cache import LRUCache, get_cache
+
+
+RESPONSE_CACHE = getattr(settings, 'SOCIAL_API_RESPONSE_CACHE', None)
+RESPONSE_CACHE_SIZE = getattr(settings, 'SOCIAL_API_RESPONSE_CACHE_SIZE', 1000)
+RESPONSE_CACHE_TIMEOUTS = getattr(settings, 'SOCIAL_API_RESPONSE_CACHE_TIMEOUTS', {})
+
+
+class ResponseCache(object):
+    """
+    Cache of responses of API methods with timeouts per method. Responses are kept in the in-process LRU cache
+    or in the Django cache with alias SOCIAL_API_RESPONSE_CACHE
+    """
+
+    def __init__(self, provider, timeouts, alias=RESPONSE_CACHE, max_size=RESPONSE_CACHE_SIZE):
+        self.provider = provider
+        self.timeouts = timeouts
+        # pickle responses in memory as well, so cached objects are not shared between callers
+        self.cache = get_cache(alias) if alias else LRUCache(max_size)
+
+    def get_timeout(self, method):
+        return self.timeouts.get(method)
+
+    def get_key(self, method, args, kwargs, context=()):
+        """
+        Returns key of response, context is a hashable key of call context, that could affect response
+        """
+        params = repr((method, args, sorted(kwargs.items()), context))
+        return 'social_api_response_%s_%s' % (self.provider, hashlib.md5(params.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """
+        Returns tuple (hit, response)
+        """
+        value = self.cache.get(key)
+        if value is None:
+            return False, None
+        return True, pickle.loads(value)
+
+    def set(self, key, response, timeout):
+        self.cache.set(key, pickle.dumps(response, pickle.HIGHEST_PROTOCOL), timeout)
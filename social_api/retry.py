@@ -0,0 +1,49 @@
+import random
+
+from django.conf import settings
+
+
+class RetryPolicy(object):
+    """
+    Limits of repeating calls: maximum number of attempts, exponential backoff with jitter between them
+    and overall deadline in seconds since the start of call
+    """
+
+    def __init__(self, max_attempts=10, backoff=1, backoff_factor=2, backoff_max=30, jitter=0.5, deadline=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def get_delay(self, attempt):
+        """
+        Returns seconds to wait before the attempt, counting from 1 for the first repeat
+        """
+        delay = min(self.backoff_max, self.backoff * self.backoff_factor ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def __repr__(self):
+        return '<RetryPolicy max_attempts=%s, backoff=%s, deadline=%s>' % (self.max_attempts, self.backoff,
+                                                                           self.deadline)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy(**getattr(settings, 'SOCIAL_API_RETRY_POLICY', {}))
+
+
+class RepeatCall(object):
+    """
+    Result of error handler, that asks to repeat the call with arguments after backoff of retry policy or given seconds
+    """
+
+    def __init__(self, kind, error=None, args=(), kwargs=None, sleep=True, seconds=None):
+        self.kind = kind
+        self.error = error
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.sleep = sleep
+        self.seconds = seconds
+
+    def __repr__(self):
+        return '<RepeatCall %s: %s>' % (self.kind, self.error)
@@ -0,0 +1,158 @@
+import hashlib
+import random
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .utils import check_deadline
+
+
+# number of random choices before the scan of all tokens for not excluded one
+RANDOM_PROBES = 10
+# number of tokens, which counters are read from shared cache by one request
+SHARED_BATCH_SIZE = 50
+
+
+def reserve_random(tokens, exclude=()):
+    """
+    Returns tuple (token, 0) with random not excluded token or (None, None) if all tokens are excluded
+    """
+    if not exclude:
+        return random.choice(tokens), 0
+    for i in range(RANDOM_PROBES):
+        token = random.choice(tokens)
+        if token not in exclude:
+            return token, 0
+    tokens = [token for token in tokens if token not in exclude]
+    return (random.choice(tokens), 0) if tokens else (None, None)
+
+
+class TokenSchedulerAbstractBase(object):
+    """
+    Chooses access token for the next request of provider
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    @abstractmethod
+    def reserve(self, tokens, exclude=()):
+        """
+        Returns tuple (token, 0) with reserved token, (None, seconds) with minimal time to wait for any token
+        or (None, None) if all tokens are excluded
+        """
+        pass
+
+    def choose(self, tokens, exclude=()):
+        """
+        Returns reserved token or None if all tokens are excluded
+        """
+        while True:
+            token, wait = self.reserve(tokens, exclude)
+            if token is not None or wait is None:
+                return token
+            check_deadline(wait, 'waiting for rate limit of tokens')
+            time.sleep(wait)
+
+    def drain(self, token):
+        """
+        Mark that provider rejected token because of rate limit. Returns True if scheduler will wait for it's budget
+        """
+        return False
+
+
+class RandomTokenScheduler(TokenSchedulerAbstractBase):
+
+    def reserve(self, tokens, exclude=()):
+        return reserve_random(tokens, exclude)
+
+
+class TokenBucketScheduler(TokenSchedulerAbstractBase):
+    """
+    Keeps bucket of requests per access token, filled with rate of provider from SOCIAL_API_TOKENS_RATE_LIMITS.
+    Buckets are kept in memory or in cache from SOCIAL_API_TOKENS_RATE_LIMITS_CACHE shared between processes
+    """
+
+    def __init__(self, provider, rate=None, capacity=None, cache=None):
+        super(TokenBucketScheduler, self).__init__(provider)
+        self.rate = rate or getattr(settings, 'SOCIAL_API_TOKENS_RATE_LIMITS', {}).get(provider)
+        self.capacity = capacity or self.rate
+        cache = cache or getattr(settings, 'SOCIAL_API_TOKENS_RATE_LIMITS_CACHE', None)
+        self.cache = caches[cache] if cache else None
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens, exclude=()):
+        if not self.rate:
+            return reserve_random(tokens, exclude)
+        if self.cache:
+            return self._reserve_shared(tokens, exclude)
+
+        # start from random position to spread load evenly between tokens with budget
+        offset = random.randrange(len(tokens))
+        wait = None
+        for i in range(len(tokens)):
+            token = tokens[(offset + i) % len(tokens)]
+            if token in exclude:
+                continue
+            token_wait = self._consume(token)
+            if not token_wait:
+                return token, 0
+            wait = token_wait if wait is None else min(wait, token_wait)
+        return None, wait
+
+    def drain(self, token):
+        if not self.rate:
+            return False
+        if self.cache:
+            self.cache.set(self._get_cache_key(token, int(time.time())), self.rate, 1)
+        else:
+            with self._lock:
+                self._buckets[token] = (0, time.time())
+        return True
+
+    def _consume(self, token):
+        now = time.time()
+        with self._lock:
+            available, updated_at = self._buckets.get(token, (self.capacity, now))
+            available = min(self.capacity, available + (now - updated_at) * self.rate)
+            if available >= 1:
+                self._buckets[token] = (available - 1, now)
+                return 0
+            self._buckets[token] = (available, now)
+            return (1 - available) / self.rate
+
+    def _reserve_shared(self, tokens, exclude):
+        # fixed window of one second with atomic counter for all processes. Counters of batch of tokens are read
+        # by one request and only the chosen token is incremented
+        now = time.time()
+        window = int(now)
+        offset = random.randrange(len(tokens))
+        candidates = (tokens[(offset + i) % len(tokens)] for i in range(len(tokens)))
+        candidates = [token for token in candidates if token not in exclude]
+        if not candidates:
+            return None, None
+
+        for start in range(0, len(candidates), SHARED_BATCH_SIZE):
+            batch = candidates[start:start + SHARED_BATCH_SIZE]
+            keys = [(token, self._get_cache_key(token, window)) for token in batch]
+            counts = self.cache.get_many([key for token, key in keys])
+            for token, key in keys:
+                if counts.get(key, 0) < self.rate and self._incr_shared(key) <= self.rate:
+                    return token, 0
+        return None, window + 1 - now
+
+    def _incr_shared(self, key):
+        self.cache.add(key, 0, 2)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, 1, 2)
+            return 1
+
+    def _get_cache_key(self, token, window):
+        return 'social_api_rate_%s_%s_%d' % (self.provider, hashlib.md5(token.encode('utf-8')).hexdigest(), window)
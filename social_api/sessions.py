@@ -0,0 +1,40 @@
+import threading
+
+from django.conf import settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+
+HTTP_POOL_SIZE = getattr(settings, 'SOCIAL_API_HTTP_POOL_SIZE', 10)
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def create_session(pool_size):
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(provider, pool_size=None):
+    """
+    Returns keep-alive requests session of provider, shared by clients of all it's tokens. Connection pool
+    of each host keeps up to pool_size connections, by default SOCIAL_API_HTTP_POOL_SIZE
+    """
+    session = _sessions.get(provider)
+    if session is None:
+        with _lock:
+            session = _sessions.get(provider)
+            if session is None:
+                session = _sessions[provider] = create_session(pool_size or HTTP_POOL_SIZE)
+    return session
+
+
+def close_sessions():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
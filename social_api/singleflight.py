@@ -0,0 +1,109 @@
+import copy
+import sys
+import threading
+
+import six
+from django.conf import settings
+from six.moves import cPickle as pickle
+
+from .lock import cache, distributedlock, LockNotAcquiredError, wait_for
+from .utils import check_deadline, get_remaining_time
+
+
+SINGLEFLIGHT_TIMEOUT = getattr(settings, 'SOCIAL_API_SINGLEFLIGHT_TIMEOUT', 60)
+
+# marker of failed call of another process
+FAILED = 'failed'
+
+
+def copy_result(result, pickled=None):
+    """
+    Returns copy of result for the waiter of identical call, so callers don't share mutable result
+    """
+    try:
+        return pickle.loads(pickled or pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return copy.deepcopy(result)
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.pickled = None
+        self.exc_info = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Executes only one of identical concurrent calls, others wait for it and get copies of it's result.
+    Calls are coalesced inside the process and optionally between processes using distributed lock and cache
+    """
+
+    def __init__(self, timeout=SINGLEFLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, distributed=False):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            else:
+                flight.waiters += 1
+
+        if not leader:
+            if not flight.event.wait(self.get_timeout()):
+                check_deadline(action='waiting for identical call')
+                return func()
+            if flight.exc_info:
+                six.reraise(*flight.exc_info)
+            return copy_result(flight.result, flight.pickled)
+
+        try:
+            flight.result = self._do_distributed(key, func) if distributed else func()
+            if flight.waiters:
+                # pickle once for all waiters, that came before the end of the call
+                try:
+                    flight.pickled = pickle.dumps(flight.result, pickle.HIGHEST_PROTOCOL)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    pass
+            return flight.result
+        except Exception:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+    def get_timeout(self):
+        # don't wait longer than the deadline of the current call
+        remaining = get_remaining_time()
+        return self.timeout if remaining is None else max(0, min(self.timeout, remaining))
+
+    def _do_distributed(self, key, func):
+        lock_name = 'social_api_singleflight_%s' % key
+        result_key = '%s_result' % lock_name
+        try:
+            with distributedlock(lock_name, blocking=False):
+                cache.delete(result_key)
+                try:
+                    result = func()
+                except Exception:
+                    cache.set(result_key, FAILED, self.timeout)
+                    raise
+                cache.set(result_key, pickle.dumps(result, pickle.HIGHEST_PROTOCOL), self.timeout)
+                return result
+        except LockNotAcquiredError:
+            value = wait_for(lambda: cache.get(result_key), self.get_timeout())
+            if value is None:
+                check_deadline(action='waiting for identical call of another process')
+            if value is None or value == FAILED:
+                # another process failed or didn't finish in time, make the call by ourselves
+                return func()
+            return pickle.loads(value)
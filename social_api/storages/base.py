@@ -1,6 +1,5 @@
 import logging
 from abc import ABCMeta, abstractmethod, abstractproperty
-from django.conf import settings
 
 
 class TokensStorageAbstractBase(object):
@@ -25,15 +24,28 @@ class TokensStorageAbstractBase(object):
     def refresh_tokens(self):
         pass
 
+    @classmethod
+    def prefetch_tokens(cls, providers):
+        """
+        Returns dict with lists of tokens of providers in the default context.
+        Storages could load tokens of all providers at once
+        """
+        return dict((provider, list(cls(provider).get_tokens())) for provider in providers)
+
+    @classmethod
+    def clear_cache(cls):
+        """
+        Clears tokens cached by storage in process
+        """
+        pass
+
     def __init__(self, provider, *args, **kwargs):
         self.provider = provider
         self.logger = self.get_logger()
 
     def get_from_context(self, name):
-        key = '_'.join([self.name, name])
-        context = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', None)
-        if context and self.provider in context and key in context[self.provider]:
-            return context[self.provider][key]
+        from ..utils import get_call_context
+        return get_call_context(self.provider).get('_'.join([self.name, name]))
 
     def get_logger(self):
         return logging.getLogger('%s_api' % self.provider)
@@ -1,11 +1,25 @@
 import time
+
+from django.conf import settings
 from oauth_tokens.models import AccessToken, UserCredentials, AccessTokenGettingError, AccessTokenRefreshingError
 
-from ..lock import distributedlock, LockNotAcquiredError
-from ..utils import limit_errored_calls
+from ..cache import incr
+from ..lock import cache, distributedlock, LockNotAcquiredError, wait_for
+from ..metrics import timer
+from ..singleflight import SingleFlight
+from ..utils import check_deadline, get_remaining_time, limit_errored_calls
 from .base import TokensStorageAbstractBase
 
 
+UPDATE_TOKENS_TIMEOUT = getattr(settings, 'SOCIAL_API_UPDATE_TOKENS_TIMEOUT', 60 * 5)
+GENERATION_TIMEOUT = 60 * 60 * 24
+# seconds between checks of the lock of another process, that could fail without the new generation
+LOCK_PROBE_INTERVAL = 5
+
+# threads of the process wait for the first one, that updates tokens or waits for another process
+singleflight = SingleFlight(timeout=UPDATE_TOKENS_TIMEOUT)
+
+
 class OAuthTokensStorage(TokensStorageAbstractBase):
 
     name = 'oauth_tokens'
@@ -14,37 +28,86 @@ class OAuthTokensStorage(TokensStorageAbstractBase):
         super(OAuthTokensStorage, self).__init__(*args, **kwargs)
         self.tag = self.get_from_context('tag')
         self.only_this = bool(self.tag)
+        self.fetched_tokens = None
+        self.fetched_at = None
 
     def get_tokens(self):
+        # use tokens fetched by the last update instead of query, if they are not outdated
+        tokens, self.fetched_tokens = self.fetched_tokens, None
+        if tokens is not None and not self.tag and time.time() - self.fetched_at < UPDATE_TOKENS_TIMEOUT:
+            return tokens
+
         queryset = AccessToken.objects.filter(provider=self.provider).order_by('-granted_at')
         if self.tag:
             queryset = queryset.filter(user_credentials__in=UserCredentials.objects.filter(tags__name=self.tag))
         return queryset.values_list('access_token', flat=True)
 
+    @classmethod
+    def prefetch_tokens(cls, providers):
+        tokens = dict((provider, []) for provider in providers)
+        queryset = AccessToken.objects.filter(provider__in=providers).order_by('-granted_at')
+        for provider, token in queryset.values_list('provider', 'access_token'):
+            tokens[provider].append(token)
+        return tokens
+
     @limit_errored_calls(AccessTokenGettingError, 5)
     def update_tokens(self):
-        lock_name = 'update_tokens_for_%s' % self.provider
+        self.fetched_tokens, result = singleflight.do(
+            'update_tokens_for_%s' % self.provider,
+            lambda: self.run_once('update_tokens', lambda: AccessToken.objects.fetch(provider=self.provider)))
+        self.fetched_at = time.time()
+        return True
+
+    @limit_errored_calls(AccessTokenRefreshingError, 5)
+    def refresh_tokens(self):
+        self.fetched_tokens, result = singleflight.do(
+            'refresh_tokens_for_%s' % self.provider,
+            lambda: self.run_once('refresh_tokens', lambda: AccessToken.objects.refresh(self.provider)))
+        self.fetched_at = time.time()
+        return result
+
+    def run_once(self, name, func):
+        """
+        The first process runs func under the lock and increments generation of the operation in cache with
+        it's result and fetched tokens, others wait for the new generation and get them from cache.
+        Returns tuple (tokens, result), tokens are None if they are unknown
+        """
+        lock_name = '%s_for_%s' % (name, self.provider)
+        generation_key = 'social_api_%s_generation_%s' % (name, self.provider)
+        generation = cache.get(generation_key) or 0
         try:
-            # the first call of method will update tokens, all others will just wait for releasing the lock
             with distributedlock(lock_name, blocking=False):
-                # self.logger.info("Updating access tokens, method: %s, recursion count: %d" % (self.method,
-                #                                                                               self.recursion_count))
-                AccessToken.objects.fetch(provider=self.provider)
-                return True
+                result = func()
+                tokens = list(AccessToken.objects.filter(provider=self.provider).order_by('-granted_at')
+                              .values_list('access_token', flat=True))
+                generation = incr(cache, generation_key, GENERATION_TIMEOUT)
+                cache.set('%s_%d' % (generation_key, generation), (tokens, result), UPDATE_TOKENS_TIMEOUT)
+                return tokens, result
         except LockNotAcquiredError:
-            # wait until lock will be released and return
-            updated = False
-            while not updated:
-                # self.logger.info("Updating access tokens, waiting for another execution, method: %s, recursion "
-                #                  "count: %d" % (self.method, self.recursion_count))
+            probed_at = [time.time()]
+
+            def get_new_generation():
+                new_generation = cache.get(generation_key) or 0
+                if new_generation > generation:
+                    return new_generation
+                if time.time() - probed_at[0] < LOCK_PROBE_INTERVAL:
+                    return None
+                probed_at[0] = time.time()
                 try:
+                    # lock is released without the new generation, if func of another process failed
                     with distributedlock(lock_name, blocking=False):
-                        updated = True
+                        return 0
                 except LockNotAcquiredError:
-                    time.sleep(1)
-            return True
+                    return None
 
-    @limit_errored_calls(AccessTokenRefreshingError, 5)
-    def refresh_tokens(self):
-        # TODO: implement the same logic of distributedlock as in update_tokens method
-        return AccessToken.objects.refresh(self.provider)
+            timeout = UPDATE_TOKENS_TIMEOUT
+            remaining = get_remaining_time()
+            if remaining is not None:
+                timeout = max(0, min(timeout, remaining))
+            with timer(self.provider, 'lock_wait', operation=name):
+                generation = wait_for(get_new_generation, timeout)
+            if generation is None:
+                check_deadline(action='%s by another process' % name)
+            if generation:
+                return cache.get('%s_%d' % (generation_key, generation)) or (None, None)
+            return None, None
@@ -1,6 +1,12 @@
+import json
+import threading
+import time
+
+import six
 from social.apps.django_app.default.models import UserSocialAuth
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_save, post_delete
 
 from .base import TokensStorageAbstractBase
 
@@ -13,6 +19,95 @@ PROVIDERS_MAP = getattr(settings, 'SOCIAL_API_SOCIAL_AUTH_PROVIDERS_MAP', {
     'twitter': 'twitter',
 })
 
+# index is rebuilt after timeout to get changes made by other processes
+INDEX_TIMEOUT = getattr(settings, 'SOCIAL_API_SOCIAL_AUTH_INDEX_TIMEOUT', 60 * 5)
+
+
+def get_access_token(extra_data):
+    # values of JSONField are not always converted by values_list
+    if isinstance(extra_data, six.string_types):
+        extra_data = json.loads(extra_data)
+    return extra_data.get('access_token')
+
+
+class TokensIndex(object):
+    """
+    In-process index of access tokens {social provider: {user id: {social auth id: token}}}. It's built by one
+    lean scan of the table and updated by signals of UserSocialAuth model instead of rescanning
+    """
+
+    def __init__(self, timeout=INDEX_TIMEOUT):
+        self.timeout = timeout
+        self._index = {}
+        self._tokens = {}
+        self._built_at = {}
+        self._lock = threading.RLock()
+
+    def get_tokens(self, provider, user_id=None):
+        with self._lock:
+            if self._built_at.get(provider, 0) + self.timeout < time.time():
+                self.build([provider])
+            if user_id is not None:
+                return list(self._index[provider].get(user_id, {}).values())
+            if self._tokens.get(provider) is None:
+                self._tokens[provider] = [token for tokens in self._index[provider].values()
+                                          for token in tokens.values()]
+            return self._tokens[provider]
+
+    def build(self, providers):
+        index = dict((provider, {}) for provider in providers)
+        queryset = UserSocialAuth.objects.filter(provider__in=providers)
+        for provider, pk, user_id, extra_data in queryset.values_list('provider', 'id', 'user_id',
+                                                                      'extra_data').iterator():
+            token = get_access_token(extra_data)
+            if token:
+                index[provider].setdefault(user_id, {})[pk] = token
+        with self._lock:
+            for provider in providers:
+                self._index[provider] = index[provider]
+                self._tokens[provider] = None
+                self._built_at[provider] = time.time()
+
+    def update(self, instance):
+        with self._lock:
+            if instance.provider not in self._index:
+                return
+            self._remove(instance)
+            token = get_access_token(instance.extra_data or {})
+            if token:
+                self._index[instance.provider].setdefault(instance.user_id, {})[instance.pk] = token
+
+    def remove(self, instance):
+        with self._lock:
+            if instance.provider in self._index:
+                self._remove(instance)
+
+    def _remove(self, instance):
+        self._tokens[instance.provider] = None
+        for tokens in self._index[instance.provider].values():
+            tokens.pop(instance.pk, None)
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+            self._tokens.clear()
+            self._built_at.clear()
+
+
+tokens_index = TokensIndex()
+
+
+def update_tokens_index(sender, instance, **kwargs):
+    tokens_index.update(instance)
+
+
+def remove_from_tokens_index(sender, instance, **kwargs):
+    tokens_index.remove(instance)
+
+
+post_save.connect(update_tokens_index, sender=UserSocialAuth, dispatch_uid='social_api_update_tokens_index')
+post_delete.connect(remove_from_tokens_index, sender=UserSocialAuth, dispatch_uid='social_api_remove_tokens_index')
+
 
 class SocialAuthTokensStorage(TokensStorageAbstractBase):
 
@@ -23,6 +118,19 @@ class SocialAuthTokensStorage(TokensStorageAbstractBase):
         self.user = self.get_from_context('user')
         self.only_this = bool(self.user)
 
+    @classmethod
+    def prefetch_tokens(cls, providers):
+        providers_map = dict((PROVIDERS_MAP[provider], provider) for provider in providers if provider in PROVIDERS_MAP)
+        tokens_index.build(list(providers_map))
+        tokens = dict((provider, []) for provider in providers)
+        for social_provider, provider in providers_map.items():
+            tokens[provider] = list(tokens_index.get_tokens(social_provider))
+        return tokens
+
+    @classmethod
+    def clear_cache(cls):
+        tokens_index.clear()
+
     def get_provider(self):
         try:
             return PROVIDERS_MAP[self.provider]
@@ -31,10 +139,8 @@ class SocialAuthTokensStorage(TokensStorageAbstractBase):
                                        "with value for provider %s", self.provider)
 
     def get_tokens(self):
-        queryset = UserSocialAuth.objects.filter(provider=self.get_provider())
-        if self.user:
-            queryset = queryset.filter(user=self.user)
-        return [s.extra_data['access_token'] for s in queryset]
+        user_id = getattr(self.user, 'pk', self.user) if self.user else None
+        return tokens_index.get_tokens(self.get_provider(), user_id)
 
     def update_tokens(self):
         pass
@@ -2,6 +2,8 @@
 from django.test import TestCase
 from django.conf import settings
 
+from .utils import clear_tokens_cache
+
 
 class SocialApiTestCase(TestCase):
     _settings = None
@@ -12,6 +14,7 @@ class SocialApiTestCase(TestCase):
         context = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', {})
         self._settings = dict(context)
         context.update({self.provider: {'token': self.token}})
+        clear_tokens_cache()
 
     def tearDown(self):
         setattr(settings, 'SOCIAL_API_CALL_CONTEXT', self._settings)
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
+import threading
+import time
+
 import mock
+from requests.exceptions import ConnectionError
+from unittest import skipIf
 from django.test import TestCase
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -8,8 +13,25 @@ from oauth_tokens.factories import AccessTokenFactory, UserCredentialsFactory
 from oauth_tokens.models import AccessTokenGettingError
 from vkontakte_api.api import VkontakteApi
 
+from . import warmup
 from .api import override_api_context
-from .exceptions import CallsLimitError
+from .affinity import HashRing
+from .breakers import CircuitBreaker
+from .cache import LocalCache
+from .exceptions import CallsLimitError, CallTimeoutError, CircuitOpenError, NoActiveTokens
+from .health import TokensHealth
+from .lock import cache, distributedlock
+from .metrics import MetricsCollector
+from .pagination import CursorPagination, OffsetPagination
+from .responses import ResponseCache
+from .retry import RetryPolicy
+from .schedulers import RandomTokenScheduler, TokenBucketScheduler
+from .sessions import HTTP_POOL_SIZE, get_session
+from .singleflight import SingleFlight
+from .usage import TokensUsage
+from .storages.oauthtokens import OAuthTokensStorage
+from .storages.social_auth import SocialAuthTokensStorage
+from .utils import get_call_context, get_storages, get_storages_tokens, clear_tokens_cache
 
 
 TOKEN = 'b492c0a63455412b67c579422119da1bf73ce07e3bf28f18fa8446c2441844eee57232ca15b7229122dd2'
@@ -21,13 +43,103 @@ def raise_error(*args, **kwargs):
 
 class SocialApiUnitTest(TestCase):
 
+    def setUp(self):
+        clear_tokens_cache()
+        VkontakteApi().invalidate_clients()
+
     def test_override_api_context(self):
-        with self.settings(SOCIAL_API_CALL_CONTEXT={}):
-            self.assertEqual(settings.SOCIAL_API_CALL_CONTEXT, {})
+        with self.settings(SOCIAL_API_CALL_CONTEXT={'vkontakte': {'user': 2}}):
+            self.assertEqual(get_call_context('vkontakte'), {'user': 2})
             with override_api_context('vkontakte', user=1):
-                self.assertEqual(settings.SOCIAL_API_CALL_CONTEXT, {'vkontakte': {'user': 1}})
+                self.assertEqual(get_call_context('vkontakte'), {'user': 1})
                 with override_api_context('vkontakte', token='abc'):
-                    self.assertEqual(settings.SOCIAL_API_CALL_CONTEXT, {'vkontakte': {'user': 1, 'token': 'abc'}})
+                    self.assertEqual(get_call_context('vkontakte'), {'user': 1, 'token': 'abc'})
+                    self.assertEqual(get_call_context('facebook'), {})
+
+                    # context is local for the thread
+                    contexts = []
+                    thread = threading.Thread(target=lambda: contexts.append(get_call_context('vkontakte')))
+                    thread.start()
+                    thread.join()
+                    self.assertEqual(contexts, [{'user': 2}])
+
+                self.assertEqual(get_call_context('vkontakte'), {'user': 1})
+            self.assertEqual(get_call_context('vkontakte'), {'user': 2})
+            self.assertEqual(settings.SOCIAL_API_CALL_CONTEXT, {'vkontakte': {'user': 2}})
+
+        # one instance could be entered by many threads at the same time
+        shared = override_api_context('vkontakte', token='abc')
+        entered, exited = threading.Event(), threading.Event()
+        contexts = []
+
+        def enter_in_thread():
+            with shared:
+                entered.set()
+                exited.wait()
+            contexts.append(get_call_context('vkontakte'))
+
+        with override_api_context('vkontakte', oauth_tokens_tag='tag'):
+            thread = threading.Thread(target=enter_in_thread)
+            thread.start()
+            entered.wait()
+            with shared:
+                exited.set()
+                thread.join()
+            self.assertEqual(get_call_context('vkontakte'), {'oauth_tokens_tag': 'tag'})
+        self.assertEqual(contexts, [{}])
+
+    def test_warmup(self):
+        for i in range(0, 3):
+            AccessTokenFactory(provider='vkontakte')
+        UserSocialAuth.objects.create(user=get_user_model().objects.create(), uid=1, provider='vk-oauth2',
+                                      extra_data='{"access_token": "%s"}' % TOKEN)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(warmup(providers=['vkontakte', 'facebook']), {'vkontakte': 4, 'facebook': 0})
+
+        api = VkontakteApi()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(api.get_tokens()), 4)
+            self.assertIn(TOKEN, api.get_tokens())
+
+        # prefetched tokens are not used by storages limited by the context
+        with override_api_context('vkontakte', oauth_tokens_tag='tag'):
+            self.assertEqual(get_storages_tokens('vkontakte', {OAuthTokensStorage: {'vkontakte': [TOKEN]}}), [])
+
+    def test_social_auth_tokens_index(self):
+        user = get_user_model().objects.create(username='user')
+        social_auth = UserSocialAuth.objects.create(user=user, uid=1, provider='vk-oauth2',
+                                                    extra_data='{"access_token": "%s"}' % TOKEN)
+        storage = SocialAuthTokensStorage('vkontakte')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(storage.get_tokens(), [TOKEN])
+            self.assertEqual(storage.get_tokens(), [TOKEN])
+
+        # index is updated by signals, tokens are returned without queries
+        UserSocialAuth.objects.create(user=get_user_model().objects.create(username='user2'), uid=2,
+                                      provider='vk-oauth2', extra_data='{"access_token": "token2"}')
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(storage.get_tokens()), sorted([TOKEN, 'token2']))
+        social_auth.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(storage.get_tokens(), ['token2'])
+
+        with override_api_context('vkontakte', social_auth_user=user):
+            self.assertEqual(SocialAuthTokensStorage('vkontakte').get_tokens(), [])
+
+    def test_get_storages_cache(self):
+        storages = get_storages('vkontakte')
+        self.assertIs(get_storages('vkontakte'), storages)
+        self.assertFalse(any(storage.only_this for storage in storages))
+
+        with override_api_context('vkontakte', oauth_tokens_tag='tag'):
+            tagged_storages = get_storages('vkontakte')
+            self.assertIsNot(tagged_storages, storages)
+            self.assertIs(get_storages('vkontakte'), tagged_storages)
+            self.assertTrue(any(storage.only_this for storage in tagged_storages))
+
+        self.assertIs(get_storages('vkontakte'), storages)
 
     def test_social_auth_user_argument(self):
         user = get_user_model().objects.create(username='user')
@@ -68,8 +180,584 @@ class SocialApiUnitTest(TestCase):
         for i in range(0, 5):
             UserSocialAuth.objects.create(user=get_user_model().objects.create(username=i), uid=i,
                                           provider='vk-oauth2', extra_data='{"access_token": "qwewekrjhshe"}')
+        api.invalidate_tokens()
         self.assertEqual(len(api.get_tokens()), 10)
 
+    def test_tokens_pool_cache(self):
+        for i in range(0, 5):
+            AccessTokenFactory(provider='vkontakte')
+        api = VkontakteApi()
+
+        with self.assertNumQueries(2):
+            self.assertEqual(len(api.get_tokens()), 5)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(api.get_tokens()), 5)
+            api.get_token()
+
+        token = AccessTokenFactory(provider='vkontakte')
+        self.assertEqual(len(api.get_tokens()), 5)
+        api.mark_token_used(token.access_token)
+        self.assertEqual(len(api.get_tokens()), 6)
+        api.used_access_tokens = []
+
+        # cache is dropped when error handler marks token as used
+        token = AccessTokenFactory(provider='vkontakte')
+        self.assertEqual(len(api.get_tokens()), 6)
+        api.used_access_tokens = [token.access_token]
+        api.record_failed_tokens(token.access_token, 0)
+        api.used_access_tokens = []
+        self.assertEqual(len(api.get_tokens()), 7)
+
+        # tokens of another context are cached separately
+        user_cr = UserCredentialsFactory()
+        user_cr.tags.add('tag')
+        AccessTokenFactory(provider='vkontakte', access_token=TOKEN, user_credentials=user_cr)
+        with override_api_context('vkontakte', oauth_tokens_tag='tag'):
+            self.assertEqual(api.get_tokens(), [TOKEN])
+        self.assertEqual(len(api.get_tokens()), 7)
+
+    def test_lazy_tokens_and_exclusion(self):
+        AccessTokenFactory(provider='vkontakte')
+        user_cr = UserCredentialsFactory()
+        user_cr.tags.add('tag')
+        AccessTokenFactory(provider='vkontakte', access_token=TOKEN, user_credentials=user_cr)
+        api = VkontakteApi()
+
+        # storage with only_this flag excludes others without querying them
+        with override_api_context('vkontakte', oauth_tokens_tag='tag'), \
+                mock.patch.object(SocialAuthTokensStorage, 'get_tokens') as get_tokens:
+            self.assertEqual(api.get_storages_tokens(), [TOKEN])
+            self.assertFalse(get_tokens.called)
+
+        scheduler = RandomTokenScheduler('vkontakte')
+        tokens = [str(i) for i in range(0, 100)]
+        for i in range(0, 100):
+            self.assertEqual(scheduler.choose(tokens, set(tokens[1:])), '0')
+        self.assertIsNone(scheduler.choose(tokens, set(tokens)))
+
+        api.used_access_tokens = [TOKEN]
+        self.assertIn(TOKEN, api.used_access_tokens)
+        self.assertRaises(NoActiveTokens, api.choose_token, [TOKEN])
+        api.used_access_tokens = []
+
+    def test_shared_session(self):
+        api = VkontakteApi()
+        session = api.get_session()
+        self.assertIs(api.get_session(), session)
+        self.assertIsNot(get_session('instagram'), session)
+        self.assertEqual(session.get_adapter('https://api.vk.com/').poolmanager.connection_pool_kw['maxsize'],
+                         HTTP_POOL_SIZE)
+
+    def test_clients_cache(self):
+        token = AccessTokenFactory(provider='vkontakte').access_token
+        api = VkontakteApi()
+        with mock.patch.object(VkontakteApi, 'get_api', autospec=True, side_effect=lambda self, token: object()) \
+                as get_api, mock.patch.object(VkontakteApi, 'get_api_response', autospec=True,
+                                              side_effect=lambda self, *args, **kwargs: self.api):
+            client = api.call('users.get')
+            self.assertIs(api.call('users.get'), client)
+            self.assertEqual(get_api.call_count, 1)
+
+            with mock.patch.object(OAuthTokensStorage, 'update_tokens'):
+                api.update_tokens()
+            self.assertIsNot(api.call('users.get'), client)
+            self.assertEqual(get_api.call_count, 2)
+
+        # client of quarantined token is dropped
+        self.assertIsNotNone(api.clients.get(token))
+        with mock.patch.object(api, 'health', TokensHealth('vkontakte')):
+            api.used_access_tokens = [token]
+            api.record_failed_tokens(token, 0)
+            api.used_access_tokens = []
+            self.assertTrue(api.health.is_quarantined(token))
+        self.assertIsNone(api.clients.get(token))
+
+    def test_token_affinity(self):
+        tokens = [AccessTokenFactory(provider='vkontakte').access_token for i in range(0, 10)]
+        api = VkontakteApi()
+        with override_api_context('vkontakte', affinity=1):
+            api.set_context()
+            token = api.get_token()
+            self.assertEqual(set(api.get_token() for i in range(0, 20)), set([token]))
+            # the next token on the ring is used when the token is excluded
+            api.used_access_tokens = [token]
+            self.assertNotEqual(api.get_token(), token)
+            api.used_access_tokens = []
+
+        # adding of token remaps only keys of the new token
+        ring = HashRing(tokens)
+        new_ring = HashRing(tokens + ['new'])
+        for key in range(0, 1000):
+            self.assertIn(new_ring.get_node(key), [ring.get_node(key), 'new'])
+
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    def test_tokens_usage(self, get_api):
+        tokens = [AccessTokenFactory(provider='vkontakte').access_token for i in range(0, 3)]
+        api = VkontakteApi()
+        api.usage = TokensUsage('vkontakte', limit=2, cache='default', flush_size=1)
+        try:
+            with mock.patch.object(VkontakteApi, 'get_api_response', autospec=True,
+                                   side_effect=lambda self, *args, **kwargs: self.token):
+                used = [api.call('users.get') for i in range(0, 6)]
+            self.assertEqual(sorted(used), sorted(tokens * 2))
+
+            # counters are shared through cache
+            usage = TokensUsage('vkontakte', limit=2, cache='default')
+            self.assertEqual(usage.get_used(tokens), dict((token, 2) for token in tokens))
+            self.assertEqual(api.get_tokens_usage()[tokens[0]]['remaining'], 0)
+
+            # quotas are read once per flush interval
+            with mock.patch.object(usage, 'get_remaining', wraps=usage.get_remaining) as get_remaining:
+                self.assertIsNone(usage.choose(tokens))
+                self.assertIsNone(usage.choose(tokens))
+            self.assertEqual(get_remaining.call_count, 1)
+
+            # tokens with quota, that wait for budget of scheduler, are skipped
+            api.usage = TokensUsage('vkontakte', limit=100, cache='default')
+            scheduler = TokenBucketScheduler('vkontakte', rate=1)
+            scheduler.drain(tokens[0])
+            scheduler.drain(tokens[1])
+            with mock.patch.object(api, 'scheduler', scheduler), api.call_scope('users.get'):
+                started_at = time.time()
+                self.assertEqual(api.get_token(), tokens[2])
+                self.assertLess(time.time() - started_at, 0.5)
+                self.assertEqual(list(api.used_access_tokens), [])
+        finally:
+            api.usage = None
+
+    def test_call_many(self):
+        tokens = [AccessTokenFactory(provider='vkontakte').access_token for i in range(0, 3)]
+        api = VkontakteApi()
+        with mock.patch.object(VkontakteApi, 'get_api', autospec=True, side_effect=lambda self, token: token), \
+                mock.patch.object(VkontakteApi, 'get_api_response', autospec=True,
+                                  side_effect=lambda self, **kwargs: (self.api, kwargs['id'])):
+            responses = list(api.call_many('users.get', [{'id': i} for i in range(0, 9)], concurrency=3))
+
+        self.assertEqual([response[1] for response in responses], list(range(0, 9)))
+        self.assertEqual(set(response[0] for response in responses), set(tokens))
+
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    def test_iter_call(self, get_api):
+        api = VkontakteApi()
+
+        def get_page(offset=0, count=100, cursor=None):
+            # provider limits size of page
+            count = min(count, 100)
+            if cursor is not None:
+                offset = cursor
+            return {'count': 250, 'items': list(range(250))[offset:offset + count],
+                    'next_cursor': offset + count if offset + count < 250 else None}
+
+        with override_api_context('vkontakte', token=TOKEN):
+            for pagination, prefetch, pages in [(OffsetPagination(count=100), False, 3),
+                                                (OffsetPagination(count=50), True, 5),
+                                                (OffsetPagination(count=200), False, 3),
+                                                (CursorPagination(), False, 3), (CursorPagination(), True, 3)]:
+                with mock.patch.object(VkontakteApi, 'get_api_response', side_effect=get_page) as get_api_response:
+                    items = api.iter_call('wall.get', pagination=pagination, prefetch=prefetch)
+                    self.assertEqual(next(items), 0)
+                    self.assertEqual(list(items), list(range(1, 250)))
+                    self.assertEqual(get_api_response.call_count, pages)
+
+        self.assertRaises(ValueError, list, api.iter_call('wall.get'))
+
+    def test_call_state_is_thread_local(self):
+        api = VkontakteApi()
+
+        def get_api_response(self, *args, **kwargs):
+            time.sleep(0.01)
+            return self.method, self.api
+
+        results = {}
+
+        def call(method):
+            results[method] = api.call(method)
+
+        with override_api_context('vkontakte', token=TOKEN), \
+                mock.patch.object(VkontakteApi, 'get_api', autospec=True, side_effect=lambda self, token: token), \
+                mock.patch.object(VkontakteApi, 'get_api_response', autospec=True, side_effect=get_api_response):
+            threads = [threading.Thread(target=call, args=('method%d' % i,)) for i in range(0, 10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, dict(('method%d' % i, ('method%d' % i, TOKEN)) for i in range(0, 10)))
+
+    def test_token_bucket_scheduler(self):
+        scheduler = TokenBucketScheduler('vkontakte', rate=2)
+        tokens = ['token1', 'token2']
+
+        self.assertEqual(sorted(scheduler.reserve(tokens)[0] for i in range(0, 4)),
+                         ['token1', 'token1', 'token2', 'token2'])
+        token, wait = scheduler.reserve(tokens)
+        self.assertIsNone(token)
+        self.assertTrue(0 < wait <= 0.5)
+
+        time.sleep(wait)
+        self.assertIn(scheduler.choose(tokens), tokens)
+
+        scheduler.drain('token1')
+        self.assertEqual(scheduler.reserve(['token1'])[0], None)
+
+    @mock.patch('social_api.schedulers.time.time', return_value=1000.5)
+    def test_token_bucket_scheduler_shared(self, time_mock):
+        scheduler = TokenBucketScheduler('vkontakte', rate=1, cache='default')
+        tokens = ['shared_token%d' % i for i in range(0, 3)]
+
+        with mock.patch.object(scheduler.cache, 'incr', wraps=scheduler.cache.incr) as incr:
+            self.assertEqual(sorted(scheduler.reserve(tokens)[0] for i in range(0, 3)), tokens)
+            # only chosen tokens are counted
+            self.assertEqual(incr.call_count, 3)
+            self.assertEqual(scheduler.reserve(tokens), (None, 0.5))
+            self.assertEqual(incr.call_count, 3)
+
+    @mock.patch.object(VkontakteApi, 'retry_policy', RetryPolicy(max_attempts=3, backoff=0))
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    def test_retry_policy(self, get_api):
+        api = VkontakteApi()
+        with override_api_context('vkontakte', token=TOKEN):
+            with mock.patch.object(VkontakteApi, 'get_api_response', side_effect=[ConnectionError, 'response']):
+                self.assertEqual(api.call('users.get'), 'response')
+                self.assertEqual(api.recursion_count, 1)
+
+            with mock.patch.object(VkontakteApi, 'get_api_response', side_effect=ConnectionError) as get_api_response:
+                with self.assertRaises(CallsLimitError):
+                    api.call('users.get')
+                self.assertEqual(get_api_response.call_count, 3)
+
+        policy = RetryPolicy(backoff=1, backoff_factor=2, backoff_max=5, jitter=0)
+        self.assertEqual([policy.get_delay(attempt) for attempt in range(1, 6)], [1, 2, 4, 5, 5])
+
+    @mock.patch.object(VkontakteApi, 'retry_policy', RetryPolicy(max_attempts=100, backoff=0.02, backoff_factor=1,
+                                                                 jitter=0))
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    def test_call_timeout(self, get_api):
+        api = VkontakteApi()
+        with override_api_context('vkontakte', token=TOKEN, timeout=0.1):
+            with mock.patch.object(VkontakteApi, 'get_api_response', autospec=True,
+                                   side_effect=lambda self, *args, **kwargs: self.get_request_timeout(10)):
+                self.assertTrue(0 < api.call('users.get') <= 0.1)
+
+            started_at = time.time()
+            with mock.patch.object(VkontakteApi, 'get_api_response', side_effect=ConnectionError) as get_api_response:
+                self.assertRaises(CallTimeoutError, api.call, 'users.get')
+            self.assertLess(time.time() - started_at, 0.2)
+            self.assertTrue(1 < get_api_response.call_count <= 6)
+
+        # rate limit is not waited after the deadline
+        scheduler = TokenBucketScheduler('vkontakte', rate=1)
+        scheduler.choose(['token1'])
+        with override_api_context('vkontakte', token='token1', timeout=0.1), \
+                mock.patch.object(api, 'scheduler', scheduler):
+            self.assertRaises(CallTimeoutError, api.call, 'users.get')
+
+    @mock.patch.object(VkontakteApi, 'retry_policy', RetryPolicy(max_attempts=3, backoff=0.001, jitter=0))
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    def test_metrics(self, get_api):
+        AccessTokenFactory(provider='vkontakte')
+        collector = MetricsCollector()
+        collector.connect()
+        try:
+            with mock.patch.object(VkontakteApi, 'get_api_response', side_effect=[ConnectionError, 'response']):
+                self.assertEqual(VkontakteApi().call('users.get'), 'response')
+        finally:
+            collector.disconnect()
+
+        tags = {'provider': 'vkontakte', 'method': 'users.get'}
+        self.assertEqual(collector.get_timing('call', **tags)['count'], 1)
+        self.assertEqual(collector.get_timing('request', **tags)['count'], 1)
+        self.assertEqual(collector.get_timing('token_selection', **tags)['count'], 2)
+        self.assertEqual(collector.get_timing('storage_query', provider='vkontakte')['count'], 1)
+        self.assertEqual(collector.get_counter('retries', kind='repeat', **tags), 1)
+        self.assertEqual(collector.get_timing('sleep', kind='repeat', **tags)['sum'], 0.001)
+        self.assertIn('social_api_retries_total{kind="repeat",method="users.get",provider="vkontakte"} 1',
+                      collector.to_prometheus())
+
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    def test_repeat_call_outside_of_call_chain(self, get_api):
+        api = VkontakteApi()
+        with override_api_context('vkontakte', token=TOKEN):
+            with mock.patch.object(VkontakteApi, 'get_api_response', side_effect=['response1', 'response2',
+                                                                                  'response3']):
+                self.assertEqual(api.call('users.get'), 'response1')
+                # overrides of `call` repeat it after the call chain is finished
+                self.assertEqual(api.repeat_call(), 'response2')
+                self.assertEqual(api.sleep_repeat_call(seconds=0), 'response3')
+
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    def test_error_without_code_is_reraised(self, get_api):
+        error = VkontakteApi.error_class.__new__(VkontakteApi.error_class)
+        self.assertFalse(hasattr(error, 'code'))
+        with override_api_context('vkontakte', token=TOKEN), \
+                mock.patch.object(VkontakteApi, 'get_api_response', side_effect=error):
+            with self.assertRaises(VkontakteApi.error_class) as context:
+                VkontakteApi().call('users.get')
+        self.assertIs(context.exception, error)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker('vkontakte', LocalCache(), failure_threshold=0.5, min_calls=4, recovery_timeout=0.1)
+        breaker.record_success()
+        for i in range(0, 3):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+
+        self.assertFalse(breaker.allow())
+        with self.assertRaises(CircuitOpenError):
+            breaker.check()
+
+        # after recovery timeout only one probe call is allowed
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    @mock.patch.object(VkontakteApi, 'get_api_response', side_effect=lambda *args, **kwargs: {'id': 1})
+    def test_response_cache(self, get_api_response, get_api):
+        api = VkontakteApi()
+        api.response_cache = ResponseCache('vkontakte', {'users.get': 60})
+
+        with override_api_context('vkontakte', token=TOKEN):
+            response = api.call('users.get', user_ids=1)
+            response['id'] = 2
+            self.assertEqual(api.call('users.get', user_ids=1), {'id': 1})
+            self.assertEqual(get_api_response.call_count, 1)
+
+            api.call('users.get', user_ids=2)
+            api.call('wall.get', owner_id=1)
+            api.call('wall.get', owner_id=1)
+            self.assertEqual(get_api_response.call_count, 4)
+
+            with override_api_context('vkontakte', response_cache=False):
+                api.call('users.get', user_ids=1)
+            self.assertEqual(get_api_response.call_count, 5)
+
+    def test_singleflight(self):
+        singleflight = SingleFlight()
+        calls = []
+
+        def call():
+            calls.append(1)
+            time.sleep(0.1)
+            return {'items': [1]}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(singleflight.do('key', call)))
+                   for i in range(0, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'items': [1]}] * 5)
+        # each caller gets it's own copy of the result
+        self.assertEqual(len(set(id(result) for result in results)), 5)
+
+        # finished calls are not cached
+        singleflight.do('key', call)
+        self.assertEqual(len(calls), 2)
+
+    def test_tokens_health(self):
+        health = TokensHealth('vkontakte', penalty=0.1, max_penalty=1)
+        health.record_success('token1', latency=0.5)
+        self.assertFalse(health.is_quarantined('token1'))
+        self.assertEqual(health.get_stats('token1')['latency'], 0.5)
+
+        health.record_error('token1')
+        self.assertTrue(health.is_quarantined('token1'))
+        self.assertFalse(health.is_quarantined('token2'))
+        time.sleep(0.1)
+        self.assertFalse(health.is_quarantined('token1'))
+
+        # penalty grows with each next error
+        health.record_error('token1')
+        self.assertEqual(health.get_stats('token1')['errors'], 2)
+        time.sleep(0.1)
+        self.assertTrue(health.is_quarantined('token1'))
+
+        health.record_success('token1')
+        self.assertEqual(health.get_stats('token1')['errors'], 0)
+
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    @mock.patch.object(VkontakteApi, 'get_error_code', return_value=999)
+    def test_tokens_health_of_failed_calls(self, get_error_code, get_api):
+        token = AccessTokenFactory(provider='vkontakte').access_token
+        api = VkontakteApi()
+
+        def handle_error_code_999(self, e, *args, **kwargs):
+            self.mark_token_used(self.token)
+            return 'failed'
+
+        with mock.patch.object(api, 'health', TokensHealth('vkontakte', penalty=0.1, max_penalty=1)), \
+                mock.patch.object(VkontakteApi, 'handle_error_code_999', handle_error_code_999, create=True), \
+                mock.patch.object(VkontakteApi, 'get_api_response',
+                                  side_effect=VkontakteApi.error_class.__new__(VkontakteApi.error_class)):
+            self.assertEqual(api.call('users.get'), 'failed')
+            self.assertTrue(api.health.is_quarantined(token))
+            time.sleep(0.1)
+            self.assertEqual(api.call('users.get'), 'failed')
+            # errors are not reset by the call, so penalty is doubled
+            self.assertEqual(api.health.get_stats(token)['errors'], 2)
+            time.sleep(0.1)
+            self.assertTrue(api.health.is_quarantined(token))
+
+    def test_get_token_skips_quarantined_tokens(self):
+        token = AccessTokenFactory(provider='vkontakte').access_token
+        quarantined_token = AccessTokenFactory(provider='vkontakte').access_token
+        api = VkontakteApi()
+        with mock.patch.object(api, 'health', TokensHealth('vkontakte')):
+            api.health.quarantine(quarantined_token, 60)
+            for i in range(0, 20):
+                self.assertEqual(api.get_token(), token)
+
+    @skipIf(not hasattr(VkontakteApi, 'acall'), 'asyncio requires python 3.5+')
+    @mock.patch('vkontakte_api.api.VkontakteApi.get_api_response', return_value='response')
+    def test_acall(self, get_api_response):
+        import asyncio
+        api = VkontakteApi()
+        with override_api_context('vkontakte', token=TOKEN):
+            response = asyncio.get_event_loop().run_until_complete(api.acall('users.get', user_ids=1))
+
+        self.assertEqual(response, 'response')
+        self.assertEqual(get_api_response.call_count, 1)
+        self.assertEqual(get_api_response.call_args, mock.call(user_ids=1))
+
+    @skipIf(not hasattr(VkontakteApi, 'acall'), 'asyncio requires python 3.5+')
+    @mock.patch.object(VkontakteApi, 'retry_policy', RetryPolicy(max_attempts=5, backoff=0.01, jitter=0))
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    def test_acall_retries(self, get_api):
+        import asyncio
+        api = VkontakteApi()
+        sleeps = []
+
+        async def sleep(seconds):
+            sleeps.append(seconds)
+
+        # backoff of retries doesn't block the loop
+        with override_api_context('vkontakte', token=TOKEN), \
+                mock.patch('asyncio.sleep', sleep), mock.patch('time.sleep') as time_sleep, \
+                mock.patch.object(VkontakteApi, 'get_api_response',
+                                  side_effect=[ConnectionError, ConnectionError, 'response']) as get_api_response:
+            response = asyncio.get_event_loop().run_until_complete(api.acall('users.get'))
+
+        self.assertEqual(response, 'response')
+        self.assertEqual(get_api_response.call_count, 3)
+        self.assertEqual(sleeps, [0.01, 0.02])
+        self.assertFalse(time_sleep.called)
+
+    @skipIf(not hasattr(VkontakteApi, 'acall'), 'asyncio requires python 3.5+')
+    def test_acall_storages(self):
+        import asyncio
+        api = VkontakteApi()
+        loop = asyncio.get_event_loop()
+        updated = []
+
+        async def aget_tokens(storage):
+            return [TOKEN]
+
+        async def aupdate_tokens(storage):
+            updated.append(storage.provider)
+
+        # coroutines of storages are used if they are defined, otherwise sync methods are run in executor
+        with mock.patch.object(OAuthTokensStorage, 'aget_tokens', aget_tokens, create=True), \
+                mock.patch.object(OAuthTokensStorage, 'aupdate_tokens', aupdate_tokens, create=True), \
+                mock.patch.object(OAuthTokensStorage, 'get_tokens') as get_tokens, \
+                mock.patch.object(SocialAuthTokensStorage, 'get_tokens', return_value=['token2']), \
+                mock.patch.object(SocialAuthTokensStorage, 'update_tokens') as update_tokens:
+            loop.run_until_complete(api.aupdate_tokens())
+            self.assertEqual(updated, ['vkontakte'])
+            self.assertEqual(update_tokens.call_count, 1)
+
+            self.assertEqual(sorted(loop.run_until_complete(api.aget_tokens())), sorted([TOKEN, 'token2']))
+            self.assertFalse(get_tokens.called)
+
+    @skipIf(not hasattr(VkontakteApi, 'acall'), 'asyncio requires python 3.5+')
+    @mock.patch.object(VkontakteApi, 'get_api', return_value=None)
+    @mock.patch.object(VkontakteApi, 'coalesce_methods', ['users.get'])
+    def test_acall_coalescing(self, get_api):
+        import asyncio
+        api = VkontakteApi()
+        calls = []
+
+        async def aget_api_response(self, *args, **kwargs):
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return {'items': [1]}
+
+        async def call_concurrently(cancel_first=False):
+            tasks = [asyncio.ensure_future(api.acall('users.get', user_ids=1)) for i in range(0, 3)]
+            if cancel_first:
+                await asyncio.sleep(0.05)
+                tasks[0].cancel()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        loop = asyncio.get_event_loop()
+        with override_api_context('vkontakte', token=TOKEN), \
+                mock.patch.object(VkontakteApi, 'aget_api_response', aget_api_response, create=True):
+            responses = loop.run_until_complete(call_concurrently())
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(responses, [{'items': [1]}] * 3)
+            # each task gets it's own copy of the response
+            self.assertEqual(len(set(id(response) for response in responses)), 3)
+
+            # waiting tasks make the call by themselves, if the first task is cancelled
+            responses = loop.run_until_complete(call_concurrently(cancel_first=True))
+            self.assertIsInstance(responses[0], asyncio.CancelledError)
+            self.assertEqual(responses[1:], [{'items': [1]}] * 2)
+            self.assertEqual(len(calls), 3)
+
+    @mock.patch('oauth_tokens.models.AccessToken.objects.fetch')
+    def test_oauth_tokens_update_tokens_shares_fetched_tokens(self, fetch):
+        for i in range(0, 3):
+            AccessTokenFactory(provider='vkontakte')
+        api = VkontakteApi()
+        api.update_tokens()
+        self.assertEqual(fetch.call_count, 1)
+
+        # fetched tokens of oauth_tokens storage are used without query
+        with self.assertNumQueries(1):
+            self.assertEqual(len(api.get_tokens()), 3)
+
+    @mock.patch('oauth_tokens.models.AccessToken.objects.refresh', return_value='refreshed')
+    def test_oauth_tokens_refresh_tokens(self, refresh):
+        self.assertEqual(OAuthTokensStorage('vkontakte').refresh_tokens(), 'refreshed')
+        self.assertEqual(refresh.call_count, 1)
+
+        # while another process refreshes tokens, storage waits for it's result
+        results = []
+        with distributedlock('refresh_tokens_for_vkontakte', blocking=False):
+            thread = threading.Thread(target=lambda: results.append(OAuthTokensStorage('vkontakte').refresh_tokens()))
+            thread.start()
+            time.sleep(0.1)
+            generation = cache.incr('social_api_refresh_tokens_generation_vkontakte')
+            cache.set('social_api_refresh_tokens_generation_vkontakte_%d' % generation, ([TOKEN], 'shared'))
+        thread.join()
+
+        self.assertEqual(results, ['shared'])
+        self.assertEqual(refresh.call_count, 1)
+
+        # result of the previous generation isn't returned, if another process failed to refresh tokens
+        results = []
+        with mock.patch('social_api.storages.oauthtokens.LOCK_PROBE_INTERVAL', 0.1):
+            with distributedlock('refresh_tokens_for_vkontakte', blocking=False):
+                thread = threading.Thread(
+                    target=lambda: results.append(OAuthTokensStorage('vkontakte').refresh_tokens()))
+                thread.start()
+                time.sleep(0.1)
+            thread.join()
+
+        self.assertEqual(results, [None])
+        self.assertEqual(refresh.call_count, 1)
+
     @mock.patch('oauth_tokens.models.AccessToken.objects.fetch', side_effect=raise_error)
     def test_oauth_tokens_update_tokens(self, fetch):
 
@@ -80,8 +768,7 @@ class SocialApiUnitTest(TestCase):
         self.assertTrue(fetch.called)
         self.assertEqual(fetch.call_count, 5)
 
-        # TODO: when we update_tokens of new instance, counter is still max, that's wrong
         api = VkontakteApi()
         with self.assertRaises(CallsLimitError):
             api.update_tokens()
-        # self.assertEqual(fetch.call_count, 10)
+        self.assertEqual(fetch.call_count, 10)
@@ -0,0 +1,170 @@
+import atexit
+import bisect
+import hashlib
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from .cache import get_cache, incr
+from .schedulers import RANDOM_PROBES
+
+
+TOKENS_USAGE = getattr(settings, 'SOCIAL_API_TOKENS_USAGE', {})
+
+
+class TokensUsage(object):
+    """
+    Counters of calls of each token and of each method of token in fixed windows of `window` seconds, kept in
+    the Django cache with alias `cache` shared between processes. Increments are accumulated in process and flushed
+    by batches of flush_size calls or after flush_interval seconds, values are read from cache not more often.
+    Quota of token is `limit` calls per window and `methods` limits {method: calls} for exact methods
+    """
+
+    def __init__(self, provider, limit=None, methods=None, window=60 * 60 * 24, cache='default', flush_size=100,
+                 flush_interval=5):
+        self.provider = provider
+        self.limit = limit
+        self.methods = methods or {}
+        self.window = window
+        self.cache = get_cache(cache)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._token_hashes = {}
+        self._pending = {}
+        self._pending_calls = 0
+        self._flushed_at = time.time()
+        self._values = {}
+        self._quotas = {}
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def get_window(self):
+        return int(time.time() // self.window)
+
+    def get_key(self, token, method, window):
+        token_hash = self._token_hashes.get(token)
+        if token_hash is None:
+            token_hash = self._token_hashes[token] = hashlib.md5(token.encode('utf-8')).hexdigest()
+        return 'social_api_usage_%s_%s_%s_%d' % (self.provider, token_hash, method or '', window)
+
+    def record(self, token, method=None):
+        window = self.get_window()
+        with self._lock:
+            for name in set([None, method]):
+                key = self.get_key(token, name, window)
+                self._pending[key] = self._pending.get(key, 0) + 1
+            self._pending_calls += 1
+            for quotas in self._quotas.values():
+                if token in quotas['remaining']:
+                    quotas['remaining'][token] -= 1
+            flush = self._pending_calls >= self.flush_size or time.time() - self._flushed_at >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending, self._pending_calls, self._flushed_at = self._pending, {}, 0, time.time()
+        for key, delta in pending.items():
+            value = incr(self.cache, key, self.window * 2, delta)
+            with self._lock:
+                self._values[key] = (value, time.time())
+
+    def get_used(self, tokens, method=None):
+        """
+        Returns dict {token: number of calls} in the current window, including not flushed calls
+        """
+        window = self.get_window()
+        keys = dict((token, self.get_key(token, method, window)) for token in tokens)
+        now = time.time()
+        with self._lock:
+            stale = [key for key in keys.values()
+                     if key not in self._values or self._values[key][1] + self.flush_interval < now]
+        if stale:
+            values = self.cache.get_many(stale)
+            with self._lock:
+                for key in stale:
+                    self._values[key] = (values.get(key) or 0, now)
+        with self._lock:
+            return dict((token, self._values[key][0] + self._pending.get(key, 0)) for token, key in keys.items())
+
+    def get_remaining(self, tokens, method=None):
+        """
+        Returns dict {token: remaining calls} in the current window or None if quota is not limited
+        """
+        method_limit = self.methods.get(method)
+        if self.limit is None and method_limit is None:
+            return None
+        remaining = dict((token, float('inf')) for token in tokens)
+        for limit, name in [(self.limit, None), (method_limit, method)]:
+            if limit is not None:
+                for token, used in self.get_used(tokens, name).items():
+                    remaining[token] = min(remaining[token], limit - used)
+        return remaining
+
+    def get_quotas(self, tokens, method=None):
+        """
+        Returns remaining quotas of tokens with bounds of their ranges for weighted choice, quotas are read once
+        per flush_interval for the same pool and decreased by calls of the process in between
+        """
+        window = self.get_window()
+        with self._lock:
+            quotas = self._quotas.get(method)
+        if quotas is None or (quotas['tokens'] is not tokens and quotas['tokens'] != tokens) \
+                or quotas['window'] != window or quotas['read_at'] + self.flush_interval < time.time():
+            remaining = self.get_remaining(tokens, method)
+            candidates, bounds, total = [], [], 0
+            for token, quota in (remaining or {}).items():
+                if quota > 0:
+                    total += quota
+                    candidates.append(token)
+                    bounds.append(total)
+            quotas = {'tokens': tokens, 'window': window, 'read_at': time.time(), 'remaining': remaining or {},
+                      'limited': remaining is not None, 'candidates': candidates, 'bounds': bounds}
+            with self._lock:
+                self._quotas[method] = quotas
+        return quotas
+
+    def choose(self, tokens, method=None, exclude=()):
+        """
+        Returns random token with probability proportional to it's remaining quota, None if quota
+        is not limited or all tokens are exhausted
+        """
+        quotas = self.get_quotas(tokens, method)
+        remaining, bounds = quotas['remaining'], quotas['bounds']
+        if not quotas['limited'] or not bounds:
+            return None
+        for i in range(RANDOM_PROBES):
+            index = min(bisect.bisect_left(bounds, random.uniform(0, bounds[-1])), len(bounds) - 1)
+            token = quotas['candidates'][index]
+            if token not in exclude and remaining[token] > 0:
+                return token
+
+        candidates = [(token, remaining[token]) for token in quotas['candidates']
+                      if token not in exclude and remaining[token] > 0]
+        if not candidates:
+            return None
+        point = random.uniform(0, sum(quota for token, quota in candidates))
+        for token, quota in candidates:
+            point -= quota
+            if point <= 0:
+                return token
+        return candidates[-1][0]
+
+    def get_stats(self, tokens):
+        """
+        Returns usage of tokens in the current window for dashboards: {token: {'used', 'remaining', 'methods'}}
+        """
+        used = self.get_used(tokens)
+        methods_used = dict((method, self.get_used(tokens, method)) for method in self.methods)
+        stats = {}
+        for token in tokens:
+            stats[token] = {
+                'used': used[token],
+                'remaining': self.limit - used[token] if self.limit is not None else None,
+                'methods': dict((method, {'used': methods_used[method][token],
+                                          'remaining': limit - methods_used[method][token]})
+                                for method, limit in self.methods.items()),
+            }
+        return stats
@@ -1,11 +1,42 @@
+import threading
 import time
+import weakref
+from contextlib import contextmanager
+from functools import wraps
 from django.utils.module_loading import import_string
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
-from django.test.utils import override_settings
 
 from .storages.base import TokensStorageAbstractBase
-from .exceptions import CallsLimitError
+from .exceptions import CallsLimitError, CallTimeoutError
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # python < 3.7, fallback to thread locals and values by asyncio task
+    ContextVar = None
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+
+def get_current_task():
+    """
+    Returns asyncio task running in the current thread or None
+    """
+    if asyncio is None:
+        return None
+    get_running_loop = getattr(asyncio, '_get_running_loop', None)
+    if get_running_loop is not None:
+        loop = get_running_loop()
+        return asyncio.Task.current_task(loop) if loop is not None else None
+    try:
+        return asyncio.Task.current_task()
+    except RuntimeError:
+        # no event loop in the thread
+        return None
 
 
 def get_storages_default():
@@ -25,44 +56,283 @@ def get_storages_default():
 
 STORAGES = get_storages_default()
 
+PROVIDERS = getattr(settings, 'SOCIAL_API_PROVIDERS', ['vkontakte', 'instagram', 'facebook', 'odnoklassniki',
+                                                       'twitter'])
+
+
+STORAGES_CACHE_SIZE = 1000
+
+_storage_classes = {}
+_storages = {}
+
+
+def get_storages(provider, *args, **kwargs):
+    """
+    Returns list of storages for provider. Storages depend only on the call context,
+    so they are cached per provider and context
+    """
+    if args or kwargs:
+        return [get_storage(import_path, provider, *args, **kwargs) for import_path in STORAGES]
+
+    key = (provider, get_context_key(provider))
+    try:
+        return _storages[key]
+    except KeyError:
+        pass
+    storages = [get_storage(import_path, provider) for import_path in STORAGES]
+    if len(_storages) >= STORAGES_CACHE_SIZE:
+        _storages.clear()
+    _storages[key] = storages
+    return storages
+
+
+def get_prioritized_storages(provider):
+    """
+    Returns storages of provider in order of priority. The first storage with only_this flag excludes all others
+    """
+    storages = get_storages(provider)
+    for storage in storages:
+        if storage.only_this:
+            return [storage]
+    return storages
+
 
-def get_storages(*args, **kwargs):
+def iter_storages_tokens(provider, prefetched=None):
+    """
+    Lazy iterator over tokens of storages of provider in the current context, tokens of each storage are requested
+    only when previous ones are exhausted. Tokens could be taken from dict {storage class: {provider: tokens}},
+    prefetched without context, so storages with only_this flag are requested anyway
+    """
+    for storage in get_prioritized_storages(provider):
+        if prefetched and type(storage) in prefetched and not storage.only_this:
+            storage_tokens = prefetched[type(storage)][provider]
+        else:
+            storage_tokens = storage.get_tokens()
+        for token in storage_tokens:
+            yield token
+
+
+def get_storages_tokens(provider, prefetched=None):
+    return list(iter_storages_tokens(provider, prefetched))
+
+
+def clear_tokens_cache():
+    """
+    Clears all tokens cached in process: pools of tokens and caches of storages
+    """
+    from .cache import tokens_pool
+    tokens_pool.invalidate()
     for import_path in STORAGES:
-        yield get_storage(import_path, *args, **kwargs)
+        get_storage_class(import_path).clear_cache()
 
 
-def get_storage(import_path, *args, **kwargs):
+def get_storage_class(import_path):
     """
-    Imports the staticfiles finder class described by import_path, where
+    Imports the tokens storage class described by import_path, where
     import_path is the full Python path to the class.
     """
+    try:
+        return _storage_classes[import_path]
+    except KeyError:
+        pass
     TokensStorage = import_string(import_path)
     if not issubclass(TokensStorage, TokensStorageAbstractBase):
-        raise ImproperlyConfigured('TokensStorage "%s" is not a subclass of "%s"' % TokensStorageAbstractBase)
-    return TokensStorage(*args, **kwargs)
+        raise ImproperlyConfigured('TokensStorage "%s" is not a subclass of "%s"' % (
+            import_path, TokensStorageAbstractBase))
+    _storage_classes[import_path] = TokensStorage
+    return TokensStorage
+
+
+def get_storage(import_path, *args, **kwargs):
+    return get_storage_class(import_path)(*args, **kwargs)
+
+
+def get_token_scheduler(provider, import_path=None):
+    """
+    Imports token scheduler class described by import_path or setting SOCIAL_API_TOKEN_SCHEDULER
+    and returns it's instance for provider
+    """
+    from .schedulers import TokenSchedulerAbstractBase
+    import_path = import_path or getattr(settings, 'SOCIAL_API_TOKEN_SCHEDULER',
+                                         'social_api.schedulers.RandomTokenScheduler')
+    TokenScheduler = import_string(import_path)
+    if not issubclass(TokenScheduler, TokenSchedulerAbstractBase):
+        raise ImproperlyConfigured('TokenScheduler "%s" is not a subclass of "%s"' % (
+            import_path, TokenSchedulerAbstractBase))
+    return TokenScheduler(provider)
+
+
+class ContextLocal(object):
+    """
+    Value local for the asyncio task and thread. Without contextvars values of tasks are kept by the current task,
+    a new task gets the value of the thread, except values made by factory, that are never shared
+    """
 
+    def __init__(self, name, factory=None):
+        self.factory = factory
+        if ContextVar is not None:
+            self._var = ContextVar(name, default=None)
+        else:
+            self._local = threading.local()
 
-def override_api_context(provider, **kwargs):
-    context = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', {provider: {}}).get(provider, {})
-    context.update(kwargs)
-    return override_settings(SOCIAL_API_CALL_CONTEXT={provider: context})
+    def get_values(self):
+        task = get_current_task()
+        if task is None:
+            return None, None
+        values = getattr(self._local, 'tasks', None)
+        if values is None:
+            values = self._local.tasks = weakref.WeakKeyDictionary()
+        return values, task
+
+    def get(self):
+        if ContextVar is not None:
+            value = self._var.get()
+        else:
+            values, task = self.get_values()
+            if task is not None and (task in values or self.factory is not None):
+                value = values.get(task)
+            else:
+                value = getattr(self._local, 'value', None)
+        if value is None and self.factory is not None:
+            value = self.factory()
+            self.set(value)
+        return value
+
+    def set(self, value):
+        if ContextVar is not None:
+            self._var.set(value)
+            return
+        values, task = self.get_values()
+        if task is not None:
+            values[task] = value
+        else:
+            self._local.value = value
+
+
+# options of the call context, that don't affect the set of available tokens
+CALL_CONTEXT_OPTIONS = ('token', 'response_cache', 'affinity', 'timeout')
+
+# contexts of providers overridden in the current thread and asyncio task
+_call_contexts = ContextLocal('social_api_call_contexts')
+# contexts replaced by entered override_api_context, as linked list of tuples (contexts, previous)
+_previous_contexts = ContextLocal('social_api_previous_contexts')
+
+
+def get_call_context(provider):
+    contexts = _call_contexts.get()
+    if contexts is not None and provider in contexts:
+        return contexts[provider]
+    context = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', None) or {}
+    return context.get(provider) or {}
+
+
+def get_call_contexts():
+    """
+    Returns contexts overridden in the current thread and task to pass them into another thread by `set_call_contexts`
+    """
+    return _call_contexts.get()
+
+
+def set_call_contexts(contexts):
+    _call_contexts.set(contexts)
+
+
+def get_context_key(provider):
+    """
+    Returns hashable key of the call context for provider, that affects the set of available tokens
+    """
+    context = get_call_context(provider)
+    return tuple((name, context[name]) for name in sorted(context) if name not in CALL_CONTEXT_OPTIONS)
+
+
+class override_api_context(object):
+    """
+    Overrides call context of provider in the current thread and asyncio task without changing settings,
+    SOCIAL_API_CALL_CONTEXT setting is used as default. Could be used as context manager and decorator
+    """
+
+    def __init__(self, provider, **kwargs):
+        self.provider = provider
+        self.kwargs = kwargs
+
+    def __enter__(self):
+        contexts = _call_contexts.get()
+        # stack of previous contexts is immutable, so tasks and threads, that got it, don't change it for others
+        _previous_contexts.set((contexts, _previous_contexts.get()))
+        contexts = dict(contexts or {})
+        contexts[self.provider] = dict(get_call_context(self.provider), **self.kwargs)
+        _call_contexts.set(contexts)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        contexts, previous = _previous_contexts.get()
+        _previous_contexts.set(previous)
+        _call_contexts.set(contexts)
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with override_api_context(self.provider, **self.kwargs):
+                return func(*args, **kwargs)
+
+        return inner
+
+
+# absolute time of the deadline of the current call in the thread and asyncio task
+_call_deadline = ContextLocal('social_api_call_deadline')
+
+
+@contextmanager
+def call_deadline(timeout):
+    """
+    Limits time of the call by timeout in seconds, the deadline of the outer call is kept if it's earlier
+    """
+    previous = _call_deadline.get()
+    deadline = time.time() + timeout if timeout is not None else None
+    if previous is not None and (deadline is None or previous < deadline):
+        deadline = previous
+    _call_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _call_deadline.set(previous)
+
+
+def get_remaining_time():
+    """
+    Returns seconds till the deadline of the current call or None if it's not limited
+    """
+    deadline = _call_deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+def check_deadline(wait=0, action='waiting'):
+    """
+    Raise CallTimeoutError if the deadline of the current call is achieved or will be achieved after waiting
+    """
+    remaining = get_remaining_time()
+    if remaining is not None and remaining <= wait:
+        raise CallTimeoutError("Deadline of the call achieved before %s, remaining %.3f sec" % (action, remaining))
 
 
 def limit_errored_calls(error, limit):
 
     def _inner_decorator(fn):
-        fn.count = 1
 
+        @wraps(fn)
         def _inner_function(*args, **kwargs):
-            try:
-                return fn(*args, **kwargs)
-            except error:
-                if fn.count < limit:
-                    time.sleep(1)
-                    fn.count += 1
-                    return _inner_function(*args, **kwargs)
-                else:
-                    raise CallsLimitError("Limit of calls %s method %s achieved" % (limit, fn))
+            # counter is local for each call, so concurrent and subsequent calls don't share it
+            count = 1
+            while True:
+                try:
+                    return fn(*args, **kwargs)
+                except error:
+                    if count < limit:
+                        check_deadline(1, 'repeat of %s' % fn.__name__)
+                        time.sleep(1)
+                        count += 1
+                    else:
+                        raise CallsLimitError("Limit of calls %s method %s achieved" % (limit, fn))
 
         return _inner_function
 